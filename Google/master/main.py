@@ -1,32 +1,38 @@
-import subprocess
+import argparse
 import os
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from colorama import Fore, Style, init
 
 # Get the current working directory dynamically
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Initialize colorama
-init()
+# Make the scripts importable so every stage runs in this process
+sys.path.append(os.path.join(base_dir, '../scripts/user'))
+sys.path.append(os.path.join(base_dir, '../scripts/device'))
 
-start_time = time.time()
-
-#---------------------------------#
-# Build paths to the script files #
-#---------------------------------#
 # Users
-google_user_data_pull_path = os.path.join(base_dir, '../scripts/user/google_user_data_pull.py')
-csv_user_data_merge_path = os.path.join(base_dir, '../scripts/user/csv_user_data_merge.py')
-move_suspended_users_path = os.path.join(base_dir, '../scripts/user/move_suspended_users.py')
-move_leerling_to_ou_path = os.path.join(base_dir, '../scripts/user/move_leerling_to_ou.py')
-move_admin_users_path = os.path.join(base_dir, '../scripts/user/move_admin_users.py')
-move_users_to_ou_path = os.path.join(base_dir, '../scripts/user/move_users_to_ou.py')
-csv_user_data_splitting_path = os.path.join(base_dir, '../scripts/user/csv_user_data_splitting.py')
+import google_user_data_pull
+import csv_user_data_merge
+import csv_user_data_splitting
+import move_suspended_users
+import move_admin_users
+import move_users_to_ou
 
 # Devices
-google_device_data_pull_path = os.path.join(base_dir, '../scripts/device/google_device_data_pull.py')
-csv_device_data_merge_path = os.path.join(base_dir, '../scripts/device/csv_device_data_merge.py')
-device_data_update_path = os.path.join(base_dir, '../scripts/device/device_data_update.py')
+import google_device_data_pull
+import csv_device_data_merge
+import device_data_update
+
+# Initialize colorama
+init()
+
+# Options shared by the stages, set from the command line
+pipeline_options = {'write_csv': True, 'incremental': False, 'full_refresh': False, 'update_devices': False}
+
+# Seconds spent per stage, reported at the end of the run
+stage_timings = {}
 
 #----------------------------#
 # Data gathering and cleanup #
@@ -34,86 +40,248 @@ device_data_update_path = os.path.join(base_dir, '../scripts/device/device_data_
 
 # Users
 def run_google_user_data_pull():
-    print(Fore.RED + "Started: google_user_data_pull.py ...")
-    print(Style.RESET_ALL + "google_user_data_pull.py logs:")
-    subprocess.run(['python', google_user_data_pull_path])
+    return google_user_data_pull.main(write_csv=pipeline_options['write_csv'])
 
-def run_csv_user_data_merge():
-    print(Fore.RED + "Started: csv_user_data_merge.py ...")
-    print(Style.RESET_ALL + "csv_user_data_merge.py logs:")
-    subprocess.run(['python', csv_user_data_merge_path])
+# The merge always merges every user, and in incremental mode only hands on the new and changed ones
+def run_csv_user_data_merge(google_users):
+    return csv_user_data_merge.main(google_users, write_csv=pipeline_options['write_csv'],
+                                    incremental=pipeline_options['incremental'],
+                                    full_refresh=pipeline_options['full_refresh'])
 
-def run_csv_user_data_splitting():
-    print(Fore.RED + "Started: csv_user_data_splitting.py ...")
-    print(Style.RESET_ALL + "csv_user_data_splitting.py logs:")
-    subprocess.run(['python', csv_user_data_splitting_path])
+# In incremental mode only the changed users flow on, so the full split CSVs are left as they are
+def run_csv_user_data_splitting(merged_users):
+    write_csv = pipeline_options['write_csv'] and not pipeline_options['incremental']
+    return csv_user_data_splitting.main(merged_users, write_csv=write_csv)
 
 # Devices
 def run_google_device_data_pull():
-    print(Fore.RED + "Started: google_device_data_pull.py ...")
-    print(Style.RESET_ALL + "google_device_data_pull.py logs:")
-    subprocess.run(['python', google_device_data_pull_path])
+    return google_device_data_pull.main(write_csv=pipeline_options['write_csv'])
 
-def run_csv_device_data_merge():
-    print(Fore.RED + "Started: csv_device_data_merge.py ...")
-    print(Style.RESET_ALL + "csv_device_data_merge.py logs:")
-    subprocess.run(['python', csv_device_data_merge_path])
+def run_csv_device_data_merge(google_devices):
+    return csv_device_data_merge.main(google_devices, write_csv=pipeline_options['write_csv'],
+                                      incremental=pipeline_options['incremental'],
+                                      full_refresh=pipeline_options['full_refresh'])
 
 #---------------#
 # Updating data #
 #---------------#
-def run_device_data_update():
-    print(Fore.RED + "Started: device_data_update.py ...")
-    print(Style.RESET_ALL + "device_data_update.py logs:")
-    subprocess.run(['python', device_data_update_path])
+def run_device_data_update(matching_devices):
+    failed_serial_numbers = device_data_update.main(matching_devices)
+    # Devices that failed to update are passed on again by the next incremental run
+    csv_device_data_merge.retry_provider_rows(failed_serial_numbers)
 
 #----------------#
 # Moving of data #
 #----------------#
 # Moving of users to there correct OU's / If the OU doesn't exist yet they will be created
-def run_move_suspended_users():
-    print(Fore.RED + "Started: move_suspended_users.py ...")
-    print(Style.RESET_ALL + "move_suspended_users.py logs:")
-    subprocess.run(['python', move_suspended_users_path])
+# Users that failed to move are passed on again by the next incremental run
+def run_move_suspended_users(split_users):
+    failed_emails = move_suspended_users.main(split_users['suspended'])
+    csv_user_data_merge.retry_user_rows(failed_emails)
 
-def run_move_admin_users():
-    print(Fore.RED + "Started: move_admin_users.py ...")
-    print(Style.RESET_ALL + "move_admin_users.py logs:")
-    subprocess.run(['python', move_admin_users_path])
+def run_move_admin_users(merged_users):
+    failed_emails = move_admin_users.main(merged_users)
+    csv_user_data_merge.retry_user_rows(failed_emails)
 
-def run_move_users_to_ou():
-    print(Fore.RED + "Started: move_users_to_ou.py ...")
-    print(Style.RESET_ALL + "move_users_to_ou.py logs:")
-    subprocess.run(['python', move_users_to_ou_path])
+def run_move_users_to_ou(merged_users):
+    failed_emails = move_users_to_ou.main(merged_users)
+    csv_user_data_merge.retry_user_rows(failed_emails)
 
+#-----------------#
+# Pipeline stages #
+#-----------------#
+# Every stage lists the data it needs (inputs) and the data it produces (output).
+# 'after' orders stages that share no data but must not overlap, such as movers creating the same OUs;
+# the later stage still runs when the earlier one failed.
+# 'option' names a pipeline option that must be set for the stage to run, for stages that write to Google
+# and are not part of the default run.
+STAGES = {
+    # Users
+    'google_user_data_pull.py': {
+        'branch': 'user', 'run': run_google_user_data_pull,
+        'inputs': [], 'output': 'google_users'
+    },
+    'csv_user_data_merge.py': {
+        'branch': 'user', 'run': run_csv_user_data_merge,
+        'inputs': ['google_users'], 'output': 'merged_users'
+    },
+    'csv_user_data_splitting.py': {
+        'branch': 'user', 'run': run_csv_user_data_splitting,
+        'inputs': ['merged_users'], 'output': 'split_users'
+    },
+    'move_suspended_users.py': {
+        'branch': 'user', 'run': run_move_suspended_users,
+        'inputs': ['split_users'], 'output': None
+    },
+    'move_admin_users.py': {
+        'branch': 'user', 'run': run_move_admin_users,
+        'inputs': ['merged_users'], 'output': None, 'after': ['move_suspended_users.py']
+    },
+    # 'move_users_to_ou.py': {
+    #     'branch': 'user', 'run': run_move_users_to_ou,
+    #     'inputs': ['merged_users'], 'output': None, 'after': ['move_admin_users.py']
+    # },
 
+    # Devices
+    'google_device_data_pull.py': {
+        'branch': 'device', 'run': run_google_device_data_pull,
+        'inputs': [], 'output': 'google_devices'
+    },
+    'csv_device_data_merge.py': {
+        'branch': 'device', 'run': run_csv_device_data_merge,
+        'inputs': ['google_devices'], 'output': 'matching_devices'
+    },
+    'device_data_update.py': {
+        'branch': 'device', 'run': run_device_data_update,
+        'inputs': ['matching_devices'], 'output': None, 'option': 'update_devices'
+    },
+}
 
-if __name__ == '__main__':
-    # Execute the scripts in the desired order
 
-    #----------------------------#
-    # Data gathering and cleanup #
-    #----------------------------#
-    # Users
-    run_google_user_data_pull()
-    run_csv_user_data_merge()
-    run_csv_user_data_splitting()
-    # Devices
-    run_google_device_data_pull()
-    run_csv_device_data_merge()
+def select_stages(branches):
+    """
+    Returns the stages of the given branches, or all stages if no branch is given.
+    Stages with an 'option' are only returned if that pipeline option is set.
+    """
+    return {
+        name: stage for name, stage in STAGES.items()
+        if (not branches or stage['branch'] in branches)
+        and (stage.get('option') is None or pipeline_options[stage['option']])
+    }
+
+
+def get_dependencies(stages):
+    """
+    Returns {stage name: set of stage names whose output it needs}, derived from the inputs and outputs.
+    """
+    producers = {stage['output']: name for name, stage in stages.items() if stage['output']}
+    dependencies = {}
+    for name, stage in stages.items():
+        missing_inputs = [data for data in stage['inputs'] if data not in producers]
+        if missing_inputs:
+            raise ValueError(f"Stage {name} needs {', '.join(missing_inputs)}, which no selected stage produces.")
+        dependencies[name] = {producers[data] for data in stage['inputs']}
+    return dependencies
+
 
-    #---------------#
-    # Updating data #
-    #---------------#
+def get_orderings(stages):
+    """
+    Returns {stage name: set of selected stage names it has to run after}, from 'after'.
+    These stages only have to be done, whether they finished or failed.
+    """
+    return {name: {after for after in stage.get('after', []) if after in stages} for name, stage in stages.items()}
+
+
+def run_stage(name, stage, data):
+    """
+    Runs one stage with its inputs and records how long it took.
+    :return: Whatever the stage returns, to hand on to the stages that need it.
+    """
+    print(Fore.RED + f"Started: {name} ...")
+    print(Style.RESET_ALL + f"{name} logs:")
+    stage_start = time.time()
+    result = stage['run'](*[data[input_name] for input_name in stage['inputs']])
+    stage_timings[name] = time.time() - stage_start
+    return result
+
+
+def run_pipeline(stages, max_workers):
+    """
+    Runs the stages as soon as the stages they depend on have finished, at most max_workers at a time.
+    Independent branches (users and devices) run concurrently. A failed stage skips the stages that need its output;
+    stages that only run 'after' it still run once it is done.
+    :return: Dictionary {stage name: error} of the stages that failed.
+    """
+    dependencies = get_dependencies(stages)
+    orderings = get_orderings(stages)
+    data = {}
+    finished = set()
+    failed = {}
+    skipped = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # Skip the stages waiting on a stage that failed or was skipped
+            for name, depends_on in dependencies.items():
+                if name not in skipped and depends_on & (set(failed) | skipped):
+                    skipped.add(name)
+                    print(Fore.YELLOW + f"Skipped: {name} (depends on a stage that did not finish)" + Style.RESET_ALL)
+
+            # Start every stage whose inputs are there and whose 'after' stages are done
+            for name, depends_on in dependencies.items():
+                done = finished | set(failed) | skipped
+                if name not in done and name not in running.values() and depends_on <= finished \
+                        and orderings[name] <= done:
+                    running[executor.submit(run_stage, name, stages[name], data)] = name
+
+            if not running:
+                break
+
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed[name] = e
+                    print(Fore.RED + f"Failed: {name}: {e}" + Style.RESET_ALL)
+                    continue
+                if stages[name]['output']:
+                    data[stages[name]['output']] = result
+                finished.add(name)
+
+    return failed
+
+
+def save_incremental_state(stages, failed):
+    """
+    Saves the state of the incremental pulls of the branches whose stages all finished.
+    A branch with a failed stage keeps its previous state, so the next run passes the same delta on again.
+    The provider state is only saved when device_data_update.py ran, since nothing else acts on the device delta.
+    """
+    failed_branches = {stages[name]['branch'] for name in failed}
+    branches = {stage['branch'] for stage in stages.values()}
+    if 'user' in branches and 'user' not in failed_branches:
+        csv_user_data_merge.save_sync_state()
+    if 'device_data_update.py' in stages and 'device' not in failed_branches:
+        csv_device_data_merge.save_provider_state()
+
+
+def print_stage_timings():
+    print(Fore.GREEN + "\nTime spent per stage:")
+    for name, seconds in stage_timings.items():
+        print(f"  {name}: {seconds:.2f} seconds")
+    print(Style.RESET_ALL, end='')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the Google Workspace sync pipeline.')
+    parser.add_argument('--no-csv', action='store_true',
+                        help='Do not write the intermediate CSV files; stages hand their data on in memory.')
+    parser.add_argument('--branch', nargs='+', choices=sorted({stage['branch'] for stage in STAGES.values()}),
+                        help='Only run the stages of these branches, e.g. --branch device.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only pass on the users and provider devices that are new or changed since the previous run.')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='With --incremental, process every user and device and rebuild the stored state.')
+    parser.add_argument('--update-devices', action='store_true',
+                        help='Also run device_data_update.py, which patches the Chromebook annotations in Google.')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Maximum number of stages running at the same time (default: 2).')
+    args = parser.parse_args()
+    pipeline_options['write_csv'] = not args.no_csv
+    pipeline_options['incremental'] = args.incremental
+    pipeline_options['full_refresh'] = args.full_refresh
+    pipeline_options['update_devices'] = args.update_devices
 
-    
+    start_time = time.time()
 
-    #----------------#
-    # Moving of data #
-    #----------------#
-    # Moving of users to there correct OU's / If the OU doesn't exist yet they will be created
-    run_move_suspended_users()
-    run_move_admin_users()
-    # run_move_users_to_ou()
+    selected_stages = select_stages(args.branch)
+    failed_stages = run_pipeline(selected_stages, max(1, args.workers))
+    save_incremental_state(selected_stages, failed_stages)
 
-print(Fore.GREEN + "Full process finished in --- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+    print_stage_timings()
+    if failed_stages:
+        print(Fore.RED + f"Failed stages: {', '.join(failed_stages)}" + Style.RESET_ALL)
+    print(Fore.GREEN + "Full process finished in --- %s seconds ---" % (time.time() - start_time))
@@ -1,52 +1,169 @@
 import os
+import sys
 import time
 import pandas as pd
-import json
 
-start_time = time.time()
-
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import load_config
+from fingerprint_store import FingerprintStore
+from snapshot_store import read_frame, write_snapshot
 
 # Define base_dir for your CSV files
 base_dir = os.path.dirname(__file__)
 
-# Load device data from Google
-exported_device_data_file = os.path.join(base_dir, '../../csv/device/core/all_google_device_data.csv')
-device_data = pd.read_csv(exported_device_data_file)
+# Device data from Google, as written by google_device_data_pull.py
+exported_device_data_file = os.path.join(base_dir, '../../csv/device/core/all_google_device_data_all.csv')
 
-# Load data from provider
+# Data from provider
 provider_data_file = os.path.join(base_dir, '../../csv/device/Export_hardware.csv')
-provider_data = pd.read_csv(provider_data_file, delimiter=';')
 
-# Standardize column names
-device_data.rename(columns={'serialNumber': 'Serial Number'}, inplace=True)
-provider_data.rename(columns={'serienummer': 'Serial Number'}, inplace=True)
+# Fingerprints of the provider export rows of the previous incremental run, per serial number
+provider_state_file = os.path.join(base_dir, '../../csv/device/provider_export_state.json')
+
+# Provider state of the last incremental run; saved by save_provider_state() once the updater has finished
+pending_provider_store = None
+
+# Output files
+matching_devices_file = os.path.join(base_dir, '../../csv/device/matching_devices.csv')
+error_log_file = os.path.join(base_dir, '../../logs/google_device_error_logs.csv')
+
+def merge_device_data(device_data, provider_data):
+    """
+    Merges the Google device data with the provider export on the serial number.
+    :return: Tuple (matching_devices, error_devices) of DataFrames.
+    """
+    # Standardize column names
+    device_data = device_data.rename(columns={'serialNumber': 'Serial Number'})
+    provider_data = provider_data.rename(columns={'serienummer': 'Serial Number'})
+
+    # Merge the two datasets on the Serial Number column
+    merged_data = pd.merge(device_data, provider_data, on='Serial Number', how='outer', indicator=True)
+
+    # Separate the merged data into different categories
+    # Rows that exist in both files (matching data)
+    matching_devices = merged_data[merged_data['_merge'] == 'both']
+
+    # Rows that are only in one of the files (error logs)
+    error_devices = merged_data[merged_data['_merge'] != 'both']
+
+    return matching_devices, error_devices
+
+def write_error_log(error_devices):
+    """Writes the serial numbers found in only one of the files to the error log."""
+    with open(error_log_file, 'w') as error_log:
+        error_log.write('Serial Number,Issue Found In File\n')
+        for _, row in error_devices.iterrows():
+            if row['_merge'] == 'left_only':
+                error_log.write(f"{row['Serial Number']},all_google_device_data.csv\n")
+            elif row['_merge'] == 'right_only':
+                error_log.write(f"{row['Serial Number']},Export_hardware.csv\n")
+
+def get_provider_delta(provider_data, matched_serial_numbers, full_refresh=False):
+    """
+    Compares the provider export with the one of the previous incremental run.
+    Whether a serial number matched a Google device is stored with its row, so a device that matches for the
+    first time counts as changed even if its provider row did not change.
+    A full refresh is forced when requested, when there is no previous state, or when the last one is
+    older than DEVICE_FULL_REFRESH_DAYS (config.json, default 7).
+    The new state is not saved here, see save_provider_state().
+    :param matched_serial_numbers: Set of the serial numbers found in both Google and the provider export.
+    :return: Tuple (delta, store); delta is a tuple (added, changed, removed) of serial number sets,
+             or None on a full refresh.
+    """
+    store = FingerprintStore(provider_state_file)
+    full_refresh = full_refresh or store.needs_full_refresh(load_config().get('DEVICE_FULL_REFRESH_DAYS', 7))
+
+    columns = list(provider_data.columns) + ['matched']
+    rows_by_serial = {}
+    for row in provider_data.fillna('').astype(str).to_dict('records'):
+        row['matched'] = str(row['serienummer'] in matched_serial_numbers)
+        rows_by_serial[row['serienummer']] = row
+    added, changed, removed = store.diff(rows_by_serial, columns)
+
+    store.replace(rows_by_serial, columns, full_refresh=full_refresh)
+
+    if full_refresh:
+        return None, store
+    return ({row['serienummer'] for row in added},
+            {row['serienummer'] for row in changed},
+            {row['serienummer'] for row in removed}), store
+
+def retry_provider_rows(serial_numbers):
+    """
+    Drops serial numbers from the pending provider state, so the next incremental run passes them on again.
+    Used for the devices the updater failed to patch.
+    """
+    if pending_provider_store is None:
+        return
+    for serial_number in serial_numbers:
+        pending_provider_store.entries.pop(serial_number, None)
+
+def save_provider_state():
+    """
+    Saves the provider state of the last incremental run, so the next run only passes on what changed after it.
+    Call this once device_data_update.py has processed the matching devices; until then the previous state is
+    kept and the next run passes the same devices on again. Does nothing if no incremental run is pending.
+    """
+    global pending_provider_store
+    if pending_provider_store is None:
+        return
+    pending_provider_store.save()
+    pending_provider_store = None
+    print(f"Provider export state saved to: {provider_state_file}")
+
+def main(google_devices=None, write_csv=True, incremental=False, full_refresh=False):
+    """
+    Matches the Google devices with the provider export.
+    :param google_devices: Device rows from google_device_data_pull.main() or its stream_devices() generator;
+                           read from the device CSV if None.
+    :param write_csv: Also write the matching devices to matching_devices.csv.
+    :param incremental: Only return the matching devices whose serial number was added or changed in the
+                        provider export, or matched a Google device for the first time, since the previous
+                        incremental run. The new state is saved by save_provider_state().
+    :param full_refresh: With incremental, return every matching device and rebuild the stored state.
+    :return: List of matching device rows, with the same string values as the CSV.
+    """
+    global pending_provider_store
+    start_time = time.time()
+
+    # Load device data from Google
+    if google_devices is None:
+        device_data = read_frame(exported_device_data_file)
+    else:
+        device_data = pd.DataFrame(google_devices)
+
+    # Load data from provider
+    provider_data = pd.read_csv(provider_data_file, delimiter=';')
 
-# Merge the two datasets on the Serial Number column
-merged_data = pd.merge(device_data, provider_data, on='Serial Number', how='outer', indicator=True)
+    matching_devices, error_devices = merge_device_data(device_data, provider_data)
 
-# Separate the merged data into different categories
-# Rows that exist in both files (matching data)
-matching_devices = merged_data[merged_data['_merge'] == 'both']
+    if incremental:
+        matched_serial_numbers = set(matching_devices['Serial Number'].astype(str))
+        provider_delta, pending_provider_store = get_provider_delta(provider_data, matched_serial_numbers, full_refresh)
+        if provider_delta is None:
+            print(f"Full refresh: all {len(matching_devices)} matching devices are passed on")
+        else:
+            added, changed, removed = provider_delta
+            print(f"Provider export: {len(added)} added, {len(changed)} changed and {len(removed)} removed serial numbers")
+            if removed:
+                print(f"Removed serial numbers: {', '.join(sorted(removed))}")
+            # Only the added and changed serial numbers go on to the annotation updater
+            matching_devices = matching_devices[matching_devices['Serial Number'].astype(str).isin(added | changed)]
 
-# Rows that are only in one of the files (error logs)
-error_devices = merged_data[merged_data['_merge'] != 'both']
+    # Save results to CSV files
+    if write_csv:
+        matching_devices.to_csv(matching_devices_file, index=False)
+        write_snapshot(matching_devices_file, matching_devices, list(matching_devices.columns))
+        print("Matching devices saved to 'matching_devices.csv'")
 
-# Save results to CSV files
-matching_devices.to_csv(os.path.join(base_dir, '../../csv/device/matching_devices.csv'), index=False)
+    # Write error logs
+    write_error_log(error_devices)
+    print("Error logs saved to 'google_device_error_logs.csv'")
 
-# Write error logs
-with open(os.path.join(base_dir, '../../logs/google_device_error_logs.csv'), 'w') as error_log:
-    error_log.write('Serial Number,Issue Found In File\n')
-    for _, row in error_devices.iterrows():
-        if row['_merge'] == 'left_only':
-            error_log.write(f"{row['Serial Number']},all_google_device_data.csv\n")
-        elif row['_merge'] == 'right_only':
-            error_log.write(f"{row['Serial Number']},Export_hardware.csv\n")
+    print("Process finished in --- %s seconds ---" % (time.time() - start_time))
+    # Hand the rows on as the strings a CSV reader would see
+    return matching_devices.fillna('').astype(str).to_dict('records')
 
-print("Matching devices saved to 'matching_devices.csv'")
-print("Error logs saved to 'google_device_error_logs.csv'")
-print("Process finished in --- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+if __name__ == '__main__':
+    main()
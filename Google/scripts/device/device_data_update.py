@@ -1,78 +1,98 @@
 import os
-import csv
 import time
-import json
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import sys
 
-# Start timer
-start_time = time.time()
-
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import load_config
+from directory_batch import execute_in_concurrent_batches
+from snapshot_store import read_rows
 
 # Define base_dir for your CSV files
 base_dir = os.path.dirname(__file__)
 
-# Get the current working directory dynamically
+# Matching devices, as written by csv_device_data_merge.py
 csv_file_path = os.path.join(base_dir, '../../csv/device/matching_devices.csv')
 
+# Scope for updating ChromeOS devices
+SCOPES = ['https://www.googleapis.com/auth/admin.directory.device.chromeos']
 
-# Load Google credentials from service account file
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE,
-    scopes=['https://www.googleapis.com/auth/admin.directory.device.chromeos']
-)
+def get_current_annotation(value):
+    """Returns an annotation from the pull as compared with the new value; the pull writes 'N/A' when it is not set."""
+    value = value or ''
+    return '' if value == 'N/A' else value
 
-# Delegate credentials
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
+def get_device_changes(matching_devices):
+    """
+    Compares the wanted assetId and location of every device with the values from the pull.
+    :return: Tuple (changes, unchanged_count); changes is a list of (device_id, serial_number, asset_id, location).
+    """
+    changes = []
+    unchanged_count = 0
+    for row in matching_devices:
+        asset_id = f"{row['Voornaam leerling']} {row['Achternaam leerling']}"
+        location = row['Onderwijsinstelling']
+        if get_current_annotation(row.get('assetId')) == asset_id and get_current_annotation(row.get('location')) == location:
+            unchanged_count += 1
+            continue
+        changes.append((row['deviceId'], row['Serial Number'], asset_id, location))
+    return changes, unchanged_count
 
-service = build('admin', 'directory_v1', credentials=credentials)
+def patch_devices(changes):
+    """
+    Patches the annotatedAssetId and annotatedLocation of the changed devices with batched requests,
+    sending DEVICE_UPDATE_WORKERS batches at a time (config.json, default 4).
+    :return: Tuple (patched_count, failed_serial_numbers).
+    """
+    patched = []
+    failed = []
 
-# Function to check and update a device's assetId and location
-def update_device(device_id, asset_id, location, serial_number):
-    try:
-        # Get the current device details
-        device = service.chromeosdevices().get(customerId='my_customer', deviceId=device_id).execute()
-        current_asset_id = device.get('annotatedAssetId', '')
-        current_location = device.get('annotatedLocation', '')
+    def build_request(service, change):
+        device_id, _, asset_id, location = change
+        return service.chromeosdevices().patch(
+            customerId='my_customer',
+            deviceId=device_id,
+            body={'annotatedAssetId': asset_id, 'annotatedLocation': location},
+            fields='deviceId'
+        )
 
-        # Check if update is needed
-        if current_asset_id == asset_id and current_location == location:
-            print(f"No update needed for device with ID: {device_id}, Serial Number: {serial_number}")
-            return False
+    def on_result(change, response, exception):
+        device_id, serial_number, _, _ = change
+        if exception is not None:
+            print(f"Failed to update device with ID: {device_id}. Error: {exception}")
+            failed.append(serial_number)
+        else:
+            print(f"Successfully updated device with ID: {device_id}, Serial Number: {serial_number}")
+            patched.append(serial_number)
 
-        # Update the device
-        updated_device = {
-            'annotatedAssetId': asset_id,
-            'annotatedLocation': location
-        }
-        service.chromeosdevices().patch(customerId='my_customer', deviceId=device_id, body=updated_device).execute()
-        print(f"Successfully updated device with ID: {device_id}, Serial Number: {serial_number}")
-        return True
-    except Exception as e:
-        print(f"Failed to update device with ID: {device_id}. Error: {e}")
-        return False
+    execute_in_concurrent_batches(SCOPES, changes, build_request, on_result,
+                                  max_workers=load_config().get('DEVICE_UPDATE_WORKERS', 4))
+    return len(patched), failed
 
-# Read CSV file and update devices
-updated_count = 0
-total_count = 0
-with open(csv_file_path, mode='r', encoding='utf-8') as csvfile:
-    csv_reader = csv.DictReader(csvfile)
-    for row in csv_reader:
-        total_count += 1
-        device_id = row['deviceId']
-        asset_id = f"{row['Voornaam leerling']} {row['Achternaam leerling']}"
-        location = row['Onderwijsinstelling']
-        serial_number = row['Serial Number']
-        if update_device(device_id, asset_id, location, serial_number):
-            updated_count += 1
+def main(matching_devices=None):
+    """
+    Updates the assetId and location of the matching devices whose annotations differ from the pull.
+    :param matching_devices: Rows from csv_device_data_merge.main(); read from matching_devices.csv if None.
+    :return: List of the serial numbers that failed to update.
+    """
+    # Start timer
+    start_time = time.time()
+
+    if matching_devices is None:
+        matching_devices = read_rows(csv_file_path)
+
+    # Only devices whose annotations change are patched
+    changes, unchanged_count = get_device_changes(matching_devices)
+    patched_count, failed = patch_devices(changes)
+
+    print(f"Total devices in list: {len(matching_devices)}")
+    print(f"Total devices unchanged: {unchanged_count}")
+    print(f"Total devices updated: {patched_count}")
+    print(f"Total devices failed: {len(failed)}")
+    if failed:
+        print(f"Failed serial numbers: {', '.join(failed)}")
+    print("Process finished in --- %s seconds ---" % (time.time() - start_time))
+    return failed
 
-print(f"Total devices in list: {total_count}")
-print(f"Total devices updated: {updated_count}")
-print("Process finished in --- %s seconds ---" % (time.time() - start_time))
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,19 @@
-import json
 import csv
 import os
 import time
+import sys
 import re
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-
-# Start timer
-start_time = time.time()
-
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
+from functools import lru_cache
+
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import build_fields_mask, get_service, load_config
+from directory_cache import load_table
+from ou_index import get_ou_index
+from paginator import iter_pages, merge_page_streams
+from snapshot_store import SnapshotWriter
+from googleapiclient.errors import HttpError
+from google.auth.exceptions import RefreshError
 
 # Define base_dir for your CSV files
 base_dir = os.path.dirname(__file__)
@@ -23,90 +21,201 @@ base_dir = os.path.dirname(__file__)
 # Scopes required for the API
 SCOPES = ['https://www.googleapis.com/auth/admin.directory.device.chromeos.readonly']
 
-# Create credentials using the service account
-credentials = service_account.Credentials.from_service_account_file(
-    os.path.join(base_dir, '../../service', SERVICE_ACCOUNT_FILE), scopes=SCOPES)
-
-
-# Delegate the credentials to the admin
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-
-# Build the service
-service = build('admin', 'directory_v1', credentials=credentials)
-
-
-def list_chrome_devices():
-    devices = []
-    request = service.chromeosdevices().list(customerId='my_customer')
-    while request is not None:
-        response = request.execute()
-        devices.extend(response.get('chromeosdevices', []))
-        request = service.chromeosdevices().list_next(previous_request=request, previous_response=response)
-    return devices
-
-
+# Scope for reading the school OUs the pull is sharded on; the OU scope the movers already use
+OU_SCOPES = ['https://www.googleapis.com/auth/admin.directory.orgunit']
+
+# Largest page size chromeosdevices().list accepts
+MAX_PAGE_SIZE = 300
+
+# Define the CSV columns you want
+fields = [
+    'deviceId', 'serialNumber', 'model', 'status', 'lastSync',
+    'assetId', 'location', 'lastKnownUserEmail', 'orgUnitPath'
+]
+
+# API field each CSV column is read from
+api_fields = {
+    'deviceId': 'deviceId',
+    'serialNumber': 'serialNumber',
+    'model': 'model',
+    'status': 'status',
+    'lastSync': 'lastSync',
+    'assetId': 'annotatedAssetId',
+    'location': 'annotatedLocation',
+    'lastKnownUserEmail': 'recentUsers/email',
+    'orgUnitPath': 'orgUnitPath'
+}
+
+
+def get_school_shards():
+    """
+    Splits the device pull per top-level (school) OU, each listed with includeChildOrgunits, plus one shard
+    for the devices directly in the root OU. Set DEVICE_SHARD_BY_SCHOOL to false in config.json to list
+    all devices in one stream instead.
+    :return: Dictionary {OU path: chromeosdevices().list arguments}, or None to list all devices at once.
+    """
+    if not load_config().get('DEVICE_SHARD_BY_SCHOOL', True):
+        return None
+
+    try:
+        ou_index = get_ou_index(get_service(OU_SCOPES))
+    except (HttpError, RefreshError) as e:
+        # RefreshError: the OU scope is not granted to the service account
+        print(f"Could not list the school OUs, pulling all devices in one stream: {e}")
+        return None
+    school_ous = [ou_index.get(path) for path in ou_index.children('/')]
+    if not school_ous:
+        return None
+
+    # orgUnitPath also accepts OU ids, which avoids escaping school names
+    shards = {'/': {'orgUnitPath': school_ous[0]['parentOrgUnitId']}}
+    for school_ou in school_ous:
+        shards[school_ou['orgUnitPath']] = {'orgUnitPath': school_ou['orgUnitId'], 'includeChildOrgunits': True}
+    return shards
+
+
+def list_chrome_device_shard_pages(**list_arguments):
+    """
+    Fetches the ChromeOS devices of one shard (or of the whole customer) page by page.
+    The next pages are fetched in the background while the current one is converted and written.
+    """
+    # Build the service
+    service = get_service(SCOPES)
+    request = service.chromeosdevices().list(
+        customerId='my_customer',
+        maxResults=MAX_PAGE_SIZE,
+        projection='FULL',  # recentUsers is only returned with the FULL projection
+        fields=build_fields_mask('chromeosdevices', [api_fields[column] for column in fields]),
+        **list_arguments
+    )
+    yield from iter_pages(service.chromeosdevices(), request, 'chromeosdevices', SCOPES)
+
+
+def list_chrome_device_pages():
+    """
+    Fetches the ChromeOS devices page by page, yielding each page as soon as it arrives.
+    The school shards are listed in parallel (DEVICE_SHARD_WORKERS in config.json, default 4).
+    :return: Generator of (school OU path, devices) tuples; the OU path is None when the pull is not sharded.
+    """
+    shards = get_school_shards()
+    if not shards:
+        for chrome_devices in list_chrome_device_shard_pages():
+            yield None, chrome_devices
+        return
+
+    streams = {
+        path: lambda list_arguments=list_arguments: list_chrome_device_shard_pages(**list_arguments)
+        for path, list_arguments in shards.items()
+    }
+    yield from merge_page_streams(streams, load_config().get('DEVICE_SHARD_WORKERS', 4))
+
+
+@lru_cache(maxsize=None)
 def sanitize_domain(domain):
     # Remove special characters and domain extensions
     sanitized = re.sub(r'[^a-zA-Z0-9]', '', domain.split('.')[0])
     return sanitized
 
 
-def write_to_csv(devices, filename):
+def parse_device(device):
+    # Parse device details
+    recent_users = device.get('recentUsers', [])
+    last_known_user_email = recent_users[0].get('email', 'N/A') if recent_users else 'N/A'
+
+    return {
+        'deviceId': device.get('deviceId'),
+        'serialNumber': device.get('serialNumber', 'N/A'),
+        'model': device.get('model', 'N/A'),
+        'status': device.get('status', 'N/A'),
+        'lastSync': device.get('lastSync', 'N/A'),
+        'assetId': device.get('annotatedAssetId', 'N/A'),
+        'location': device.get('annotatedLocation', 'N/A'),
+        'lastKnownUserEmail': last_known_user_email,
+        'orgUnitPath': device.get('orgUnitPath', 'N/A')
+    }
+
+
+@lru_cache(maxsize=None)
+def get_domain_file_name(org_unit_path):
+    """
+    Returns the name of the per-domain device file for an OU path, based on its top-level OU.
+    Cached, as every device of an OU maps to the same file.
+    """
+    domain = org_unit_path.split('/')[1] if '/' in org_unit_path else 'root'
+    sanitized_domain = sanitize_domain(domain)
+    if sanitized_domain == '':
+        return 'all_google_device_data_root.csv'
+    return f'all_google_device_data_{sanitized_domain}.csv'
+
+
+def open_csv_writer(filename):
+    """Opens a device CSV file in the core folder and returns (file, writer) with the header written."""
     csv_file_path = os.path.join(base_dir, f'../../csv/device/core/{filename}')
-
-    # Define the CSV columns you want
-    fields = [
-        'deviceId', 'serialNumber', 'model', 'status', 'lastSync', 
-        'assetId', 'location', 'lastKnownUserEmail', 'orgUnitPath'
-    ]
-
-    # Open a CSV file to write with UTF-8 encoding
-    with open(csv_file_path, mode='w', newline='', encoding='utf-8') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=fields)
-        writer.writeheader()
-
-        for device in devices:
-            # Parse device details
-            recent_users = device.get('recentUsers', [])
-            last_known_user_email = recent_users[0].get('email', 'N/A') if recent_users else 'N/A'
-
-            device_data = {
-                'deviceId': device.get('deviceId'),
-                'serialNumber': device.get('serialNumber', 'N/A'),
-                'model': device.get('model', 'N/A'),
-                'status': device.get('status', 'N/A'),
-                'lastSync': device.get('lastSync', 'N/A'),
-                'assetId': device.get('annotatedAssetId', 'N/A'),
-                'location': device.get('annotatedLocation', 'N/A'),
-                'lastKnownUserEmail': last_known_user_email,
-                'orgUnitPath': device.get('orgUnitPath', 'N/A')
-            }
-            writer.writerow(device_data)
-
-    print(f"CSV file written to: {csv_file_path}")
+    os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)
+    csv_file = open(csv_file_path, mode='w', newline='', encoding='utf-8')
+    writer = csv.DictWriter(csv_file, fieldnames=fields)
+    writer.writeheader()
+    return csv_file, writer
+
+
+def stream_devices(write_csv=True):
+    """
+    Converts the devices page by page and yields the rows, so only one page of API responses is held at a time.
+    :param write_csv: Write every device as soon as it is converted, in a single pass, to
+                      all_google_device_data_all.csv and to the file of its domain. One writer is kept
+                      open per domain. The combined file also gets a snapshot.
+    """
+    csv_files = {}  # {file name: (file, writer)}
+    snapshot = None
+    try:
+        if write_csv:
+            csv_files['all_google_device_data_all.csv'] = open_csv_writer('all_google_device_data_all.csv')
+            snapshot = SnapshotWriter(csv_files['all_google_device_data_all.csv'][0].name, fields)
+
+        rows_written = 0
+        for _, chrome_devices in list_chrome_device_pages():
+            rows = [parse_device(device) for device in chrome_devices]
+            if write_csv:
+                csv_files['all_google_device_data_all.csv'][1].writerows(rows)
+                snapshot.write_rows(rows)
+                for row in rows:
+                    domain_file_name = get_domain_file_name(row.get('orgUnitPath', ''))
+                    if domain_file_name not in csv_files:
+                        csv_files[domain_file_name] = open_csv_writer(domain_file_name)
+                    csv_files[domain_file_name][1].writerow(row)
+                rows_written += len(rows)
+                print(f"Written {rows_written} devices so far")
+            yield from rows
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+        for csv_file, _ in csv_files.values():
+            csv_file.close()
+            print(f"CSV file written to: {csv_file.name}")
+
+
+def main(write_csv=True):
+    """
+    Pulls all ChromeOS devices and returns them as rows with the CSV columns.
+    Only one page of API responses is held at a time, but every converted row is kept for the cache and the merge,
+    so memory grows with the number of devices.
+    Use stream_devices() instead to process the devices one at a time while they are being pulled.
+    :param write_csv: Also write the rows to the combined and per-domain device CSV files, page by page.
+    :return: List of device rows.
+    """
+    # Start timer
+    start_time = time.time()
+
+    # The combined and per-domain files are written while the pages come in
+    chrome_devices = list(stream_devices(write_csv))
+
+    # Reports query the cache, which is only loaded together with the CSV so the two never disagree
+    if write_csv:
+        load_table('devices', chrome_devices)
+
+    print("Getting google device data took --- %s seconds ---" % (time.time() - start_time))
+    return chrome_devices
 
 
 if __name__ == '__main__':
-    chrome_devices = list_chrome_devices()
-
-    # Write all devices to a single CSV file
-    write_to_csv(chrome_devices, 'all_google_device_data_all.csv')
-
-    # Organize devices by domain
-    domain_devices = {}
-    for device in chrome_devices:
-        org_unit_path = device.get('orgUnitPath', '')
-        domain = org_unit_path.split('/')[1] if '/' in org_unit_path else 'root'
-        sanitized_domain = sanitize_domain(domain)
-        if sanitized_domain not in domain_devices:
-            domain_devices[sanitized_domain] = []
-        domain_devices[sanitized_domain].append(device)
-
-    # Write devices to separate domain-specific files
-    for domain, devices in domain_devices.items():
-        file_name = f'all_google_device_data_{domain}.csv'
-        if domain == '':
-            file_name = 'all_google_device_data_root.csv'
-        write_to_csv(devices, file_name)
-
-print("Getting google device data took --- %s seconds ---" % (time.time() - start_time))
+    main()
@@ -1,18 +1,17 @@
 import os
-import json
+import csv
 import time
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
 
-start_time = time.time()
-
-# Load configuration
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import build_fields_mask, get_service, load_config
+from directory_batch import execute_in_concurrent_batches, list_members_in_batches
+from paginator import iter_pages
+from rate_limiter import MAX_RETRIES, get_backoff_seconds
 
 # OAuth scope for group and group member management
 SCOPES = [
@@ -20,16 +19,6 @@ SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.group.member'
 ]
 
-# Authenticate using the service account and delegated admin
-credentials = service_account.Credentials.from_service_account_file(
-    os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE),
-    scopes=SCOPES
-)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-
-# Build the Admin SDK Directory service
-service = build('admin', 'directory_v1', credentials=credentials)
-
 def normalize_domain(domain):
     """
     Ensures the domain starts with an '@' symbol.
@@ -40,6 +29,7 @@ def create_group(group_name, domain):
     """
     Creates a Google Group with the specified name and domain.
     """
+    service = get_service(SCOPES)
     group_email = f"{group_name}{domain}"
     group_body = {
         "email": group_email,
@@ -63,9 +53,10 @@ def add_admin_as_owner(group_email, admin_email):
     """
     Adds the admin as an owner of the group if they are not already an owner.
     """
+    service = get_service(SCOPES)
     try:
         # Retrieve all members of the group
-        members = service.members().list(groupKey=group_email).execute()
+        members = service.members().list(groupKey=group_email, fields='members(email,role)').execute()
         
         # Check if the admin is already an owner
         if 'members' in members:
@@ -88,6 +79,7 @@ def create_groups_in_batch(domain, group_names):
     """
     Creates multiple Google Groups in the specified domain and adds the admin as an owner.
     """
+    service = get_service(SCOPES)
     normalized_domain = normalize_domain(domain)
     admin_email = f"admin{normalized_domain}"
     
@@ -110,7 +102,179 @@ def create_groups_in_batch(domain, group_names):
         if existing_group:
             add_admin_as_owner(group_email, admin_email)
 
-if __name__ == "__main__":
+# ------------------------------------------------------------------------------
+# Bulk mode: create the groups listed in a CSV file
+# ------------------------------------------------------------------------------
+def read_group_requests(csv_path):
+    """
+    Reads the groups to create from a CSV file with the columns domain, name, description and owners.
+    owners is a comma-separated list of emails; the domain admin is used when it is empty.
+    Returns a list of dictionaries {email, name, description, owners}.
+    """
+    group_requests = []
+    with open(csv_path, mode='r', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            group_name = (row.get('name') or '').strip()
+            domain = (row.get('domain') or '').strip().lower()
+            if not group_name or not domain:
+                continue
+            normalized_domain = normalize_domain(domain)
+            owners = [owner.strip().lower() for owner in (row.get('owners') or '').split(',') if owner.strip()]
+            group_requests.append({
+                'email': f"{group_name}{normalized_domain}".lower(),
+                'name': group_name,
+                'description': (row.get('description') or '').strip() or f"Group for {group_name} in domain {normalized_domain}",
+                'owners': owners or [f"admin{normalized_domain}"]
+            })
+    return group_requests
+
+def get_existing_group_emails(domain):
+    """
+    Lists the groups of a domain with one (paginated) list call.
+    Returns a set of the group emails and aliases in that domain.
+    """
+    service = get_service(SCOPES)
+    request = service.groups().list(domain=domain.lstrip('@'), maxResults=200,
+                                    fields=build_fields_mask('groups', ['email', 'aliases']))
+    existing = set()
+    for groups in iter_pages(service.groups(), request, 'groups', SCOPES):
+        for group in groups:
+            existing.add(group['email'].lower())
+            existing.update(alias.lower() for alias in group.get('aliases', []))
+    return existing
+
+def create_groups_from_csv(csv_path):
+    """
+    Creates the groups listed in a CSV file and adds their owners, without asking anything.
+    The existing groups are listed once per domain; the missing groups and the owners are then sent as batched
+    requests, GROUP_CREATE_WORKERS batches at a time (config.json, default 4).
+    The owners of existing groups are compared with their current members first: owners that are already a
+    member are promoted to OWNER, and existing owners are left alone. Owner inserts into a group that was just
+    created are retried with a backoff while the group is not visible yet (404).
+    """
+    group_requests = read_group_requests(csv_path)
+    print(f"Read {len(group_requests)} groups from {csv_path}")
+
+    groups_by_domain = defaultdict(list)
+    for group in group_requests:
+        groups_by_domain[group['email'].split('@')[-1]].append(group)
+
+    max_workers = load_config().get('GROUP_CREATE_WORKERS', 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        existing_per_domain = dict(zip(groups_by_domain, executor.map(get_existing_group_emails, groups_by_domain)))
+
+    missing_groups = []
+    existing_groups = []
+    for domain, groups in groups_by_domain.items():
+        for group in groups:
+            if group['email'] in existing_per_domain[domain]:
+                print(f"Group already exists: {group['email']}")
+                existing_groups.append(group)
+            else:
+                missing_groups.append(group)
+
+    # Create the missing groups
+    created = []
+    failed = []
+
+    def build_group_request(service, group):
+        return service.groups().insert(
+            body={"email": group['email'], "name": group['name'], "description": group['description']},
+            fields='email'
+        )
+
+    def on_group_result(group, response, exception):
+        if exception is None:
+            print(f"Group created successfully: {group['email']}")
+            created.append(group)
+        elif isinstance(exception, HttpError) and exception.resp.status == 409:
+            print(f"Group already exists: {group['email']}")
+            existing_groups.append(group)
+        else:
+            print(f"An error occurred while creating group {group['email']}: {exception}")
+            failed.append(group['email'])
+
+    execute_in_concurrent_batches(SCOPES, missing_groups, build_group_request, on_group_result,
+                                  max_workers=max_workers)
+
+    # Existing groups only get the owners they miss; a member with another role is promoted.
+    # If the members of a group cannot be listed, its owners are inserted and a 409 becomes a promotion.
+    members_per_group, lookup_failed = list_members_in_batches(
+        SCOPES, [group['email'] for group in existing_groups],
+        fields=build_fields_mask('members', ['email', 'role']), max_workers=max_workers
+    )
+    owner_changes = []
+    for group in existing_groups:
+        if group['email'] in lookup_failed:
+            print(f"An error occurred while retrieving the members of {group['email']}: {lookup_failed[group['email']]}")
+        roles = {member['email'].lower(): member.get('role') for member in members_per_group.get(group['email'], [])}
+        for owner in group['owners']:
+            if roles.get(owner) == 'OWNER':
+                print(f"{owner} is already an owner of {group['email']}.")
+            else:
+                owner_changes.append((group['email'], owner, 'update' if owner in roles else 'insert'))
+
+    # New groups have no members yet, so their owners are inserted straight away
+    owner_changes.extend((group['email'], owner, 'insert') for group in created for owner in group['owners'])
+    created_emails = {group['email'] for group in created}
+
+    owners_added = []
+    conflicts = []
+    not_found = []
+
+    def build_owner_request(service, change):
+        group_email, owner_email, action = change
+        if action == 'update':
+            return service.members().update(groupKey=group_email, memberKey=owner_email,
+                                            body={"role": "OWNER"}, fields='email,role')
+        return service.members().insert(groupKey=group_email, body={"email": owner_email, "role": "OWNER"},
+                                        fields='email,role')
+
+    def on_owner_result(change, response, exception):
+        group_email, owner_email, action = change
+        if exception is None:
+            print(f"{owner_email} added as an owner of {group_email}.")
+            owners_added.append(change)
+        elif action == 'insert' and isinstance(exception, HttpError) and exception.resp.status == 409:
+            conflicts.append((group_email, owner_email, 'update'))
+        elif group_email in created_emails and isinstance(exception, HttpError) and exception.resp.status == 404:
+            # A group that was just created can take a while to become visible to the members API
+            not_found.append(change)
+        else:
+            print(f"An error occurred while adding {owner_email} as owner of {group_email}: {exception}")
+
+    execute_in_concurrent_batches(SCOPES, owner_changes, build_owner_request, on_owner_result,
+                                  max_workers=max_workers)
+    for attempt in range(MAX_RETRIES):
+        if not not_found:
+            break
+        retries = list(not_found)
+        not_found.clear()
+        time.sleep(get_backoff_seconds(attempt))
+        execute_in_concurrent_batches(SCOPES, retries, build_owner_request, on_owner_result,
+                                      max_workers=max_workers)
+    for group_email, owner_email, _ in not_found:
+        print(f"An error occurred while adding {owner_email} as owner of {group_email}: the group is not available yet")
+    if conflicts:
+        execute_in_concurrent_batches(SCOPES, conflicts, build_owner_request, on_owner_result,
+                                      max_workers=max_workers)
+
+    print(f"Groups created: {len(created)}, already existing: {len(existing_groups)}, failed: {len(failed)}")
+    print(f"Owners added or promoted: {len(owners_added)}")
+
+def main(csv_path=None):
+    """
+    Asks for a domain and group names and creates the groups with the domain admin as owner.
+    :param csv_path: CSV file with the columns domain, name, description and owners; creates every group in it
+                     without asking anything (bulk mode).
+    """
+    start_time = time.time()
+
+    if csv_path:
+        create_groups_from_csv(csv_path)
+        print("Creating groups took --- %s seconds ---" % (time.time() - start_time))
+        return
+
     print("Welcome to the Group Creation Script!")
     
     # Get the domain
@@ -131,4 +295,8 @@ if __name__ == "__main__":
     else:
         print("No valid group names provided. Exiting.")
 
-    print("Creating groups took --- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+    print("Creating groups took --- %s seconds ---" % (time.time() - start_time))
+
+if __name__ == "__main__":
+    # Pass a CSV file to create groups in bulk, e.g. python create_group.py groups.csv
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -1,18 +1,17 @@
 import csv
 import os
 import time
-import json
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+import sys
 
-start_time = time.time()
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import build_fields_mask, get_service, load_config
+from directory_batch import list_members_in_batches
+from directory_cache import load_table
+from directory_snapshot import get_directory_snapshot
+from paginator import iter_pages
+from snapshot_store import write_snapshot
 
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
 base_dir = os.path.join(os.path.dirname(__file__))
 
 SCOPES = [
@@ -20,14 +19,6 @@ SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.group.member.readonly'
 ]
 
-credentials = service_account.Credentials.from_service_account_file(
-    os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE),
-    scopes=SCOPES
-)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-
-service = build('admin', 'directory_v1', credentials=credentials)
-
 # ------------------------------------------------------------------------------
 # Function to retrieve all groups
 # ------------------------------------------------------------------------------
@@ -36,46 +27,81 @@ def get_all_google_groups():
     Fetches all groups from the domain.
     Uses pagination to ensure we retrieve all groups if there are more than maxResults.
     """
+    service = get_service(SCOPES)
     results = []
     request = service.groups().list(
         customer='my_customer',   # 'my_customer' auto-detects your domain
-        maxResults=200            # you can use a larger page size, e.g., 500 or 1000
+        maxResults=200,           # you can use a larger page size, e.g., 500 or 1000
+        fields=build_fields_mask('groups', ['email', 'name', 'description', 'directMembersCount', 'adminCreated', 'aliases'])
     )
 
-    while request is not None:
-        response = request.execute()
-        results.extend(response.get('groups', []))
-        request = service.groups().list_next(previous_request=request, previous_response=response)
+    # The next page is fetched in the background while the current one is processed
+    for groups in iter_pages(service.groups(), request, 'groups', SCOPES):
+        results.extend(groups)
 
     return results
 
 # ------------------------------------------------------------------------------
-# Function to retrieve owners of a group
+# Functions to retrieve the owners or members of groups
 # ------------------------------------------------------------------------------
-def get_group_owners(group_email):
+def get_group_members(group_email, roles=None):
     """
-    Fetches the owners of a group by filtering members with the OWNER role.
+    Fetches the members of one group, optionally only those with the given roles (e.g. 'OWNER').
+    Use get_members_per_group() to look up many groups.
     """
-    owners = []
+    service = get_service(SCOPES)
+    members = []
     request = service.members().list(
         groupKey=group_email,
-        roles='OWNER'  # Use 'OWNER' instead of 'MANAGER'
+        roles=roles,
+        maxResults=200,
+        fields=build_fields_mask('members', ['email', 'role', 'type', 'status'])
     )
 
     while request is not None:
         response = request.execute()
-        owners.extend(response.get('members', []))
-        request = service.members().list_next(previous_request=request, previous_response=response)
+        members.extend(response.get('members', []))
+        request = service.members().list_next(request, response)
 
-    return owners
+    return members
+
+def get_group_owners(group_email):
+    """
+    Fetches the owners of a group by filtering members with the OWNER role.
+    """
+    return get_group_members(group_email, roles='OWNER')  # Use 'OWNER' instead of 'MANAGER'
+
+def get_members_per_group(groups, full_memberships=False):
+    """
+    Looks up the owners (or all members) of every group with batched members().list calls,
+    GROUP_LOOKUP_WORKERS batches at a time (config.json, default 4).
+    :return: Dictionary {group email: members}.
+    """
+    group_emails = [group['email'] for group in groups]
+    members_per_group, failed = list_members_in_batches(
+        SCOPES, group_emails,
+        fields=build_fields_mask('members', ['email', 'role', 'type', 'status']),
+        roles=None if full_memberships else 'OWNER',
+        max_workers=load_config().get('GROUP_LOOKUP_WORKERS', 4)
+    )
+
+    # An incomplete export would look like groups without owners, so stop instead
+    for group_email, exception in failed.items():
+        print(f"Error retrieving members for {group_email}: {exception}")
+    if failed:
+        raise next(iter(failed.values()))
+
+    return members_per_group
 
 # ------------------------------------------------------------------------------
 # Write group data to CSV
 # ------------------------------------------------------------------------------
-def write_groups_to_csv(groups):
+def write_groups_to_csv(groups, members_per_group):
     """
-    Writes group data to a CSV file with UTF-8 encoding.
+    Writes group data to a CSV file with UTF-8 encoding, and its snapshot.
     Includes group owners in the output.
+    :param members_per_group: Dictionary {group email: members} from get_members_per_group().
+    :return: The rows written.
     """
     csv_file_path = os.path.join(base_dir, '../../csv/groups/core/all_google_group_data.csv')
 
@@ -93,13 +119,14 @@ def write_groups_to_csv(groups):
         'owners'  # New column for group owners
     ]
 
+    rows = []
     with open(csv_file_path, mode='w', newline='', encoding='utf-8') as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=fields)
         writer.writeheader()
 
         for group in groups:
-            # Fetch owners for the group
-            owners = get_group_owners(group['email'])
+            # Owners were looked up for all groups before writing
+            owners = [member for member in members_per_group.get(group['email'], []) if member.get('role') == 'OWNER']
             owner_emails = [owner.get('email', '') for owner in owners]
 
             # Build a dict for each row
@@ -115,15 +142,78 @@ def write_groups_to_csv(groups):
                 'owners': ', '.join(owner_emails)
             }
             writer.writerow(group_data)
+            rows.append(group_data)
+
+    write_snapshot(csv_file_path, rows, fields)
+    print(f"CSV file written to: {csv_file_path}")
+    return rows
+
+# ------------------------------------------------------------------------------
+# Write group memberships to CSV
+# ------------------------------------------------------------------------------
+def write_memberships_to_csv(members_per_group):
+    """
+    Writes every member of every group to a CSV file with UTF-8 encoding, one row per membership, and its snapshot.
+    :return: The rows written.
+    """
+    csv_file_path = os.path.join(base_dir, '../../csv/groups/core/all_google_group_memberships.csv')
 
+    # Ensure the directory structure for the CSV file exists
+    os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)
+
+    fields = ['groupEmail', 'memberEmail', 'role', 'type', 'status']
+
+    rows = [
+        {
+            'groupEmail': group_email,
+            'memberEmail': member.get('email', ''),
+            'role': member.get('role', ''),
+            'type': member.get('type', ''),
+            'status': member.get('status', '')
+        }
+        for group_email, members in members_per_group.items()
+        for member in members
+    ]
+
+    with open(csv_file_path, mode='w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    write_snapshot(csv_file_path, rows, fields)
     print(f"CSV file written to: {csv_file_path}")
+    return rows
 
 # ------------------------------------------------------------------------------
 # Main execution: fetch groups, write to CSV
 # ------------------------------------------------------------------------------
-if __name__ == "__main__":
+def main(export_memberships=None):
+    """
+    Fetches all groups with their owners and writes them to all_google_group_data.csv.
+    :param export_memberships: Fetch all members instead of only the owners, in the same pass, and also
+                               write them to all_google_group_memberships.csv.
+                               Defaults to EXPORT_GROUP_MEMBERSHIPS in config.json (false).
+    :return: The rows of all_google_group_data.csv.
+    """
+    start_time = time.time()
+
+    if export_memberships is None:
+        export_memberships = load_config().get('EXPORT_GROUP_MEMBERSHIPS', False)
+
     groups = get_all_google_groups()
-    write_groups_to_csv(groups)
+    members_per_group = get_members_per_group(groups, full_memberships=export_memberships)
+    rows = write_groups_to_csv(groups, members_per_group)
+
+    # Later stages in this process look groups up in the shared directory snapshot; reports query the cache
+    get_directory_snapshot().set_table('groups', rows)
+    load_table('groups', rows)
+    if export_memberships:
+        memberships = write_memberships_to_csv(members_per_group)
+        load_table('memberships', memberships)
 
     print(f"Successfully written {len(groups)} groups to all_google_group_data.csv")
-    print("Getting Google group data took --- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+    print("Getting Google group data took --- %s seconds ---" % (time.time() - start_time))
+    return rows
+
+if __name__ == "__main__":
+    main()
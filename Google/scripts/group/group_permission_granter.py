@@ -1,21 +1,15 @@
 import os
-import csv
 import time
-import json
+import sys
 from collections import defaultdict
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from googleapiclient.errors import HttpError
 
-# Start the timer
-start_time = time.time()
-
-# Load configuration
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import build_fields_mask, load_config
+from directory_snapshot import DirectorySnapshot, get_directory_snapshot
+from directory_batch import execute_in_concurrent_batches, list_members_in_batches
+from snapshot_store import read_rows
 
 # OAuth scope for group and group member management
 SCOPES = [
@@ -23,22 +17,6 @@ SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.group.member'
 ]
 
-# Authenticate using the service account and delegated admin
-credentials = service_account.Credentials.from_service_account_file(
-    os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE),
-    scopes=SCOPES
-)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-
-# Build the Admin SDK Directory service
-service = build('admin', 'directory_v1', credentials=credentials)
-
-
-def read_csv(file_path):
-    """ Reads a CSV file and returns a list of dictionaries. """
-    with open(file_path, mode='r', encoding='utf-8') as file:
-        return list(csv.DictReader(file))
-
 
 def normalize_domain(domain):
     """ Ensures the domain starts with an '@' symbol. """
@@ -61,62 +39,102 @@ def get_valid_admins(admins):
     return valid_admins
 
 
-def get_group_members(group_email):
+def get_snapshot_owners(group):
     """
-    Retrieves all members of a group and their roles.
-    Returns a dictionary {email: role}.
+    Returns the owner emails from the `owners` column of a group row, or None if the row has no such column.
     """
-    try:
-        members = service.members().list(groupKey=group_email).execute()
-        return {m['email'].lower(): m['role'] for m in members.get('members', [])}
-    except Exception as e:
-        print(f"Error retrieving members for {group_email}: {e}")
-        return {}
+    owners = group.get('owners')
+    if owners is None:
+        return None
+    return {owner.strip().lower() for owner in owners.split(',') if owner.strip()}
 
 
-def update_member_role(group_email, admin_email):
+def get_members_per_group(group_emails):
     """
-    Updates the admin's role in the group to OWNER if they are already a MEMBER or MANAGER.
+    Retrieves the members of the given groups with batched members().list calls, GROUP_LOOKUP_WORKERS
+    batches at a time (config.json, default 4).
+    Returns a dictionary {group_email: {email: role}}; a group whose members could not be retrieved has none.
     """
-    try:
-        member_body = {"role": "OWNER"}
-        service.members().update(groupKey=group_email, memberKey=admin_email, body=member_body).execute()
-        return True
-    except Exception as e:
-        print(f"❌ Error updating admin {admin_email} to OWNER in {group_email}: {e}")
-        return False
+    members_per_group, failed = list_members_in_batches(
+        SCOPES, group_emails,
+        fields=build_fields_mask('members', ['email', 'role']),
+        max_workers=load_config().get('GROUP_LOOKUP_WORKERS', 4)
+    )
+    for group_email, exception in failed.items():
+        print(f"Error retrieving members for {group_email}: {exception}")
 
+    return {
+        group_email: {m['email'].lower(): m['role'] for m in members}
+        for group_email, members in members_per_group.items()
+    }
 
-def add_admin_as_owner(group_email, admin_email, group_members):
+
+def get_owner_change(group_email, admin_email, group_members):
+    """
+    Decides how the admin becomes an owner of the group.
+    Returns 'update' if the admin is a MEMBER or MANAGER, 'insert' if the admin is not in the group,
+    or None if the admin is already an owner.
+    """
+    if admin_email in group_members:
+        current_role = group_members[admin_email]
+        if current_role in ["MEMBER", "MANAGER"]:
+            print(f"🔄 {group_email} → Admin ({admin_email}) is already in the group as {current_role}. Updating to OWNER.")
+            return 'update'
+        elif current_role == "OWNER":
+            print(f"✅ {group_email} → Admin ({admin_email}) is already an OWNER. Skipping.")
+            return None
+    return 'insert'
+
+
+def apply_owner_changes(changes):
     """
-    Adds the admin as an owner of the group if they are not already an owner.
-    If the admin is a MEMBER or MANAGER, updates their role to OWNER instead of adding them again.
+    Sends the OWNER inserts and role updates as batched requests, GROUP_UPDATE_WORKERS batches at a time
+    (config.json, default 4).
+    An insert that fails because the admin is already a member (409) is sent again as a role update.
+    :param changes: List of (group_email, admin_email, 'insert' or 'update') tuples.
+    :return: Number of groups where the admin is now an owner.
     """
-    try:
-        if admin_email in group_members:
-            current_role = group_members[admin_email]
-            if current_role in ["MEMBER", "MANAGER"]:
-                print(f"🔄 {group_email} → Admin ({admin_email}) is already in the group as {current_role}. Updating to OWNER.")
-                return update_member_role(group_email, admin_email)
-            elif current_role == "OWNER":
-                print(f"✅ {group_email} → Admin ({admin_email}) is already an OWNER. Skipping.")
-                return False
-
-        # If the admin is not in the group, add them as an OWNER
-        member_body = {"email": admin_email, "role": "OWNER"}
-        service.members().insert(groupKey=group_email, body=member_body).execute()
-        print(f"🔄 {group_email} → Added admin ({admin_email}) as owner.")
-        return True
-
-    except Exception as e:
-        print(f"❌ Error adding admin {admin_email} to {group_email}: {e}")
-        return False
-
-
-def process_groups(admins, groups):
+    fixed = []
+    conflicts = []
+
+    def build_request(service, change):
+        group_email, admin_email, action = change
+        if action == 'update':
+            return service.members().update(groupKey=group_email, memberKey=admin_email,
+                                            body={"role": "OWNER"}, fields='email,role')
+        return service.members().insert(groupKey=group_email, body={"email": admin_email, "role": "OWNER"},
+                                        fields='email,role')
+
+    def on_result(change, response, exception):
+        group_email, admin_email, action = change
+        if exception is None:
+            if action == 'insert':
+                print(f"🔄 {group_email} → Added admin ({admin_email}) as owner.")
+            fixed.append(group_email)
+        elif action == 'insert' and isinstance(exception, HttpError) and exception.resp.status == 409:
+            print(f"🔄 {group_email} → Admin ({admin_email}) is already in the group. Updating to OWNER.")
+            conflicts.append((group_email, admin_email, 'update'))
+        elif action == 'update':
+            print(f"❌ Error updating admin {admin_email} to OWNER in {group_email}: {exception}")
+        else:
+            print(f"❌ Error adding admin {admin_email} to {group_email}: {exception}")
+
+    max_workers = load_config().get('GROUP_UPDATE_WORKERS', 4)
+    execute_in_concurrent_batches(SCOPES, changes, build_request, on_result, max_workers=max_workers)
+    if conflicts:
+        execute_in_concurrent_batches(SCOPES, conflicts, build_request, on_result, max_workers=max_workers)
+
+    return len(fixed)
+
+
+def process_groups(admins, directory, revalidate=False):
     """
     Processes groups and ensures the correct admin is set as an owner.
-    Optimized for performance while logging each group status.
+    The `owners` column of the group snapshot decides which groups are already fine; only the other
+    groups are looked up through the API, all at once, before they are fixed.
+    :param directory: DirectorySnapshot holding the groups, indexed by domain.
+    :param revalidate: Also look up the groups the snapshot reports as fine, in the same bulk lookup,
+                       for when the snapshot may be stale.
     """
     valid_admins = get_valid_admins(admins)
 
@@ -125,11 +143,11 @@ def process_groups(admins, groups):
         print(f"  ✅ {admin_email} (for {domain})")
 
     groups_by_domain = defaultdict(list)
-    for group in groups:
-        group_email = group.get('email', '').strip().lower()
-        if group_email:
-            domain = normalize_domain(group_email.split('@')[-1])
-            groups_by_domain[domain].append(group_email)
+    for domain, domain_groups in directory.groups_by_domain.items():
+        for group in domain_groups:
+            group_email = group.get('email', '').strip().lower()
+            if group_email:
+                groups_by_domain[normalize_domain(domain)].append((group_email, get_snapshot_owners(group)))
 
     total_groups = sum(len(groups) for groups in groups_by_domain.values())
     groups_with_valid_admin = 0
@@ -138,28 +156,46 @@ def process_groups(admins, groups):
 
     print("\n🔍 Processing Groups...\n")
 
+    # Decide from the snapshot which groups need to be looked up
+    groups_to_check = []  # (group_email, admin_email)
     for domain, group_list in groups_by_domain.items():
         valid_admin_email = valid_admins.get(domain)
 
         if not valid_admin_email:
             domains_without_admin.append(domain)
-            for group_email in group_list:
+            for group_email, _ in group_list:
                 print(f"⚠️ {group_email} → No valid admin for this domain. Skipping.")
             continue
 
-        for group_email in group_list:
-            group_members = get_group_members(group_email)
-
-            if valid_admin_email in group_members and group_members[valid_admin_email] == "OWNER":
+        for group_email, snapshot_owners in group_list:
+            if not revalidate and snapshot_owners is not None and valid_admin_email in snapshot_owners:
                 groups_with_valid_admin += 1
                 print(f"✅ {group_email} → Already has correct admin ({valid_admin_email}) as owner. Skipping.")
                 continue
+            groups_to_check.append((group_email, valid_admin_email))
+
+    # Look up the remaining groups in bulk and gather the changes they need
+    members_per_group = get_members_per_group([group_email for group_email, _ in groups_to_check])
+    changes = []
+    for group_email, valid_admin_email in groups_to_check:
+        group_members = members_per_group[group_email]
 
-            if add_admin_as_owner(group_email, valid_admin_email, group_members):
-                groups_fixed += 1
+        if valid_admin_email in group_members and group_members[valid_admin_email] == "OWNER":
+            groups_with_valid_admin += 1
+            print(f"✅ {group_email} → Already has correct admin ({valid_admin_email}) as owner. Skipping.")
+            continue
+
+        action = get_owner_change(group_email, valid_admin_email, group_members)
+        if action:
+            changes.append((group_email, valid_admin_email, action))
+
+    # Send all inserts and role updates in batches
+    if changes:
+        groups_fixed = apply_owner_changes(changes)
 
     print("\n🔎 Summary Report")
     print(f"📌 Total groups checked: {total_groups}")
+    print(f"🔍 Groups looked up through the API: {len(groups_to_check)}")
     print(f"✅ Groups with valid admin as owner: {groups_with_valid_admin}")
     print(f"🔄 Groups fixed (admin added): {groups_fixed}")
 
@@ -167,14 +203,33 @@ def process_groups(admins, groups):
         print(f"⚠️ Domains without valid admin: {', '.join(domains_without_admin)}")
 
 
-if __name__ == "__main__":
+def main(admins=None, groups=None, revalidate=None):
+    """
+    Ensures the admin of every domain is an owner of that domain's groups.
+    :param admins: Rows of admin_google_user_data.csv; read from that CSV if None.
+    :param groups: Rows of all_google_group_data.csv; taken from the shared directory snapshot if None.
+    :param revalidate: Look up every group instead of trusting the owners column of the snapshot.
+                       Defaults to REVALIDATE_GROUP_SNAPSHOT in config.json (false).
+    """
+    # Start the timer
+    start_time = time.time()
+
     print("🚀 Starting the script to manage group ownerships...")
 
     base_dir = os.path.join(os.path.dirname(__file__), '../../csv')
 
-    admins = read_csv(os.path.join(base_dir, 'user/core/admin_google_user_data.csv'))
-    groups = read_csv(os.path.join(base_dir, 'groups/core/all_google_group_data.csv'))
+    if admins is None:
+        admins = read_rows(os.path.join(base_dir, 'user/core/admin_google_user_data.csv'))
+    # Groups come from the shared directory snapshot, indexed by domain once for this process
+    directory = get_directory_snapshot() if groups is None else DirectorySnapshot(groups=groups)
+
+    if revalidate is None:
+        revalidate = load_config().get('REVALIDATE_GROUP_SNAPSHOT', False)
 
-    process_groups(admins, groups)
+    process_groups(admins, directory, revalidate=revalidate)
 
     print(f"🏁 Script completed in {round(time.time() - start_time, 2)} seconds.")
+
+
+if __name__ == "__main__":
+    main()
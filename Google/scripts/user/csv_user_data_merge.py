@@ -1,11 +1,52 @@
+import csv
 import pandas as pd
 import os
+import sys
 import time
 import unicodedata
-import json
+from functools import lru_cache
 
-start_time = time.time()
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import load_config
+from directory_cache import load_table
+from fingerprint_store import FingerprintStore
+from snapshot_store import read_frame, write_snapshot
 
+# Define base_dir for your CSV files
+base_dir = os.path.join(os.path.dirname(__file__))
+
+# Dynamically construct paths relative to base_dir
+intune_file = os.path.join(base_dir, '../../csv/user/core/multi_school_intune.csv')
+google_admin_file = os.path.join(base_dir, '../../csv/user/core/all_google_user_data.csv')
+output_file = os.path.join(base_dir, '../../csv/user/merged/merged_user_data.csv')
+
+# Incremental sync: the merged users of the previous run and the new/changed/deleted users of this run
+sync_state_path = os.path.join(base_dir, '../../csv/user/merged/merged_user_sync_state.json')
+delta_csv_file_path = os.path.join(base_dir, '../../csv/user/merged/merged_user_delta.csv')
+
+# Only the columns the merge needs are read. Fields with few distinct values are categorical,
+# so every value is stored once and compared by its code.
+intune_dtypes = {
+    'userPrincipalName': 'str',
+    'jobTitle': 'str',
+    'department': 'category',
+    'companyName': 'category'
+}
+google_dtypes = {
+    'primaryEmail': 'str',
+    'suspended': 'category',
+    'orgUnitPath': 'category',
+    'isAdmin': 'category'
+}
+
+# Columns of merged_user_data.csv
+merged_columns = ['userPrincipalName', 'jobTitle', 'department', 'companyName', 'suspended', 'orgUnitPath', 'isAdmin']
+
+# Merged users of the last incremental run; saved by save_sync_state() once the stages acting on the delta finished
+pending_sync_store = None
+
+@lru_cache(maxsize=None)
 def remove_special_characters(text):
     """
     This function normalizes text to remove special characters, such as accents and diacritics.
@@ -14,53 +55,177 @@ def remove_special_characters(text):
         return unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore').decode('ASCII')
     return text
 
-def merge_user_data(intune_file, google_admin_file, output_file):
+def normalize_text_column(column):
     """
-    Merges user data from Intune and Google Admin CSV files and saves the combined data.
+    Removes special characters from a text column. Every distinct value is normalized once and the column
+    is then mapped in one vectorized step, so the cost depends on the number of distinct values.
     """
-    # Read both CSV files
-    intune_df = pd.read_csv(intune_file)
-    google_admin_df = pd.read_csv(google_admin_file)
+    normalized = {value: remove_special_characters(value) for value in column.dropna().unique()}
+    return column.map(normalized)
+
+def get_email_key(column):
+    """Returns the join key for an email column: trimmed and lowercased."""
+    return column.str.strip().str.lower()
 
+def merge_user_data(intune_df, google_admin_df):
+    """
+    Merges user data from the Intune and Google Admin DataFrames and returns the combined data.
+    Users are matched on userPrincipalName and primaryEmail, ignoring case and surrounding spaces.
+    The userPrincipalName column of the result holds the Google primaryEmail of the matched user.
+    """
     # Check if 'jobTitle' column exists in Intune DataFrame
     if 'jobTitle' in intune_df.columns:
-        # Normalize the jobTitle field in Intune DataFrame
-        intune_df['jobTitle'] = intune_df['jobTitle'].apply(remove_special_characters)
+        # Normalize the jobTitle field in Intune DataFrame; job titles repeat, so keep them categorical
+        intune_df['jobTitle'] = normalize_text_column(intune_df['jobTitle']).astype('category')
     else:
         print("Warning: 'jobTitle' column not found in Intune CSV file.")
+        intune_df['jobTitle'] = pd.NA
+
+    intune_df['emailKey'] = get_email_key(intune_df['userPrincipalName'])
+    google_admin_df['emailKey'] = get_email_key(google_admin_df['primaryEmail'])
 
     # Merge the data based on matching userPrincipalName and primaryEmail
     # Assuming userPrincipalName matches primaryEmail for common users
     merged_df = pd.merge(
-        intune_df,
-        google_admin_df,
-        left_on='userPrincipalName',
-        right_on='primaryEmail',
+        intune_df.dropna(subset=['emailKey']),
+        google_admin_df.dropna(subset=['emailKey']),
+        on='emailKey',
         how='inner'
     )
 
+    # The later stages address the users in Google, so hand on their primaryEmail instead of the Intune spelling
+    merged_df['userPrincipalName'] = merged_df['primaryEmail']
+
     # Keep the relevant columns
-    filtered_df = merged_df[['userPrincipalName', 'jobTitle', 'department', 'companyName', 'suspended', 'orgUnitPath', 'isAdmin']]
+    return merged_df[merged_columns]
+
+def read_intune_data():
+    """Reads the needed columns of the Intune export with explicit dtypes."""
+    return pd.read_csv(intune_file, usecols=lambda column: column in intune_dtypes,
+                       dtype={column: dtype for column, dtype in intune_dtypes.items()})
+
+def read_google_data(google_users=None):
+    """
+    Reads the needed columns of the Google user data with explicit dtypes.
+    :param google_users: User rows from google_user_data_pull; read from all_google_user_data.csv
+                         (or its snapshot) if None.
+    """
+    if google_users is None:
+        return read_frame(google_admin_file, columns=list(google_dtypes), dtype=google_dtypes)
+
+    # Only the needed columns are taken from every row, so a stream_users() generator is never held in full
+    google_admin_df = pd.DataFrame.from_records(
+        ([row.get(column) for column in google_dtypes] for row in google_users),
+        columns=list(google_dtypes)
+    )
+    # Compare values as the strings the CSV holds, e.g. 'True' for suspended
+    return google_admin_df.fillna('').astype(str).astype(google_dtypes)
+
+def write_delta_to_csv(new_users, changed_users, deleted_users):
+    """Writes the new, changed and deleted users of an incremental sync, with the kind of change per row."""
+    os.makedirs(os.path.dirname(delta_csv_file_path), exist_ok=True)
+
+    with open(delta_csv_file_path, mode='w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=merged_columns + ['change'])
+        writer.writeheader()
+        for change, users in (('new', new_users), ('changed', changed_users), ('deleted', deleted_users)):
+            writer.writerows({**user, 'change': change} for user in users)
+
+    print(f"Delta CSV file written to: {delta_csv_file_path}")
+
+def sync_user_delta(merged_users, full_refresh=False):
+    """
+    Compares the merged users with those of the previous incremental run, per userPrincipalName.
+    Every merged column counts, so a new jobTitle or department from Intune marks a user as changed
+    just like a change in Google does.
+    A full refresh is forced when requested, when there is no previous state, or when the last one is
+    older than USER_FULL_REFRESH_DAYS (config.json, default 7).
+    The new state is not saved here, so a failing later stage does not lose the delta; see save_sync_state().
+    :return: Tuple (new, changed, deleted, full_refresh, store); on a full refresh every user counts as new.
+    """
+    store = FingerprintStore(sync_state_path)
+    full_refresh = full_refresh or store.needs_full_refresh(load_config().get('USER_FULL_REFRESH_DAYS', 7))
+
+    users_by_email = {user['userPrincipalName']: user for user in merged_users}
+    if full_refresh:
+        new_users, changed_users, deleted_users = list(users_by_email.values()), [], []
+    else:
+        new_users, changed_users, deleted_users = store.diff(users_by_email, merged_columns)
+
+    store.replace(users_by_email, merged_columns, full_refresh=full_refresh)
+    return new_users, changed_users, deleted_users, full_refresh, store
+
+def retry_user_rows(emails):
+    """
+    Drops users from the pending sync state, so the next incremental run passes them on again.
+    Used for the users a mover failed to move.
+    """
+    if pending_sync_store is None:
+        return
+    for email in emails:
+        pending_sync_store.entries.pop(email, None)
+
+def save_sync_state():
+    """
+    Saves the merged users of the last incremental run, so the next run only passes on what changed after it.
+    Call this once the stages acting on the delta have finished; until then the previous state is kept and
+    the next run passes the same users on again. Does nothing if no incremental run is pending.
+    """
+    global pending_sync_store
+    if pending_sync_store is None:
+        return
+    pending_sync_store.save()
+    pending_sync_store = None
+    print(f"User sync state saved to: {sync_state_path}")
+
+def main(google_users=None, write_csv=True, incremental=False, full_refresh=False):
+    """
+    Merges the Intune export with the Google user data.
+    :param google_users: User rows from google_user_data_pull.main() or its stream_users() generator;
+                         read from all_google_user_data.csv if None.
+    :param write_csv: Also write the merged rows to merged_user_data.csv and load them into the merged_users
+                      table of the directory cache.
+    :param incremental: Only return the merged users that are new or changed since the previous incremental run,
+                        and write the new, changed and deleted users to merged_user_delta.csv.
+                        The new state is saved by save_sync_state(), once the users have been processed.
+    :param full_refresh: With incremental, return every merged user and rebuild the stored state.
+    :return: List of merged user rows, with the same string values as the CSV.
+    """
+    global pending_sync_store
+    start_time = time.time()
+
+    # Read the Intune export and the Google user data
+    intune_df = read_intune_data()
+    google_admin_df = read_google_data(google_users)
+
+    filtered_df = merge_user_data(intune_df, google_admin_df)
 
     # Save the merged data to 'merged_user_data.csv'
-    filtered_df.to_csv(output_file, index=False)
-    print(f"Data successfully merged and saved to {output_file}")
+    if write_csv:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        filtered_df.to_csv(output_file, index=False)
+        write_snapshot(output_file, filtered_df, merged_columns)
+        print(f"Data successfully merged and saved to {output_file}")
 
-if __name__ == "__main__":
-    # Load configuration from config.json
-    config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-    with open(config_path, 'r') as config_file:
-        config = json.load(config_file)
+    # Hand the rows on as the strings a CSV reader would see
+    merged_users = filtered_df.astype(object).fillna('').astype(str).to_dict('records')
+    if write_csv:
+        load_table('merged_users', merged_users)
 
-    # Retrieve base_dir from the configuration, defaulting to the script's directory if not set
-    base_dir = os.path.join(os.path.dirname(__file__))
+    if incremental:
+        new_users, changed_users, deleted_users, full_refresh, pending_sync_store = sync_user_delta(
+            merged_users, full_refresh)
 
-    # Dynamically construct paths relative to base_dir
-    intune_file = os.path.join(base_dir, '../../csv/user/core/multi_school_intune.csv')
-    google_admin_file = os.path.join(base_dir, '../../csv/user/core/all_google_user_data.csv')
-    output_file = os.path.join(base_dir, '../../csv/user/merged/merged_user_data.csv')
+        if full_refresh:
+            print(f"Full refresh: all {len(merged_users)} merged users are passed on")
+        else:
+            print(f"{len(new_users)} new, {len(changed_users)} changed and {len(deleted_users)} deleted users")
+        if write_csv:
+            write_delta_to_csv(new_users, changed_users, deleted_users)
+        merged_users = new_users + changed_users
 
-    # Call the function with dynamically resolved file paths
-    merge_user_data(intune_file, google_admin_file, output_file)
+    print("Process finished in --- %s seconds ---" % (time.time() - start_time))
+    return merged_users
 
-print("Process finished in --- %s seconds ---" % (time.time() - start_time))
+if __name__ == "__main__":
+    main()
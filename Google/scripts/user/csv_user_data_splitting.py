@@ -1,67 +1,120 @@
 import csv
 import os
 import time
+import sys
 
-start_time = time.time()
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from directory_cache import get_columns, has_table, select_rows, true_values
+from snapshot_store import read_rows, write_snapshot
 
 # Define the paths based on your file structure
 base_dir = os.path.dirname(__file__)
 master_csv_path = os.path.join(base_dir, '../../csv/user/merged/merged_user_data.csv')
 
-# Output file paths
-suspended_csv_path = os.path.join(base_dir, '../../csv/user/split/split_suspended_google_users.csv')
-leerling_csv_path = os.path.join(base_dir, '../../csv/user/split/split_leerling_google_users.csv')
-leerkracht_csv_path = os.path.join(base_dir, '../../csv/user/split/split_leerkracht_google_users.csv')
-administratie_csv_path = os.path.join(base_dir, '../../csv/user/split/split_administratie_google_users.csv')
-non_specific_csv_path = os.path.join(base_dir, '../../csv/user/split/split_google_users.csv')
-
-# Ensure the output directory exists
-output_dir = os.path.dirname(suspended_csv_path)
-os.makedirs(output_dir, exist_ok=True)
-
-# Open the master CSV file for reading
-with open(master_csv_path, mode='r', encoding='utf-8') as master_file:
-    reader = csv.DictReader(master_file)
-    # Get fieldnames from master file
-    fieldnames = reader.fieldnames
-
-    # Open the output CSV files for writing
-    with open(suspended_csv_path, mode='w', newline='', encoding='utf-8') as suspended_file, \
-         open(leerling_csv_path, mode='w', newline='', encoding='utf-8') as leerling_file, \
-         open(leerkracht_csv_path, mode='w', newline='', encoding='utf-8') as leerkracht_file, \
-         open(administratie_csv_path, mode='w', newline='', encoding='utf-8') as administratie_file, \
-         open(non_specific_csv_path, mode='w', newline='', encoding='utf-8') as non_specific_file:
-
-        # Create CSV writers
-        suspended_writer = csv.DictWriter(suspended_file, fieldnames=fieldnames)
-        leerling_writer = csv.DictWriter(leerling_file, fieldnames=fieldnames)
-        leerkracht_writer = csv.DictWriter(leerkracht_file, fieldnames=fieldnames)
-        administratie_writer = csv.DictWriter(administratie_file, fieldnames=fieldnames)
-        non_specific_writer = csv.DictWriter(non_specific_file, fieldnames=fieldnames)
-
-        # Write headers to output files
-        suspended_writer.writeheader()
-        leerling_writer.writeheader()
-        leerkracht_writer.writeheader()
-        administratie_writer.writeheader()
-        non_specific_writer.writeheader()
-
-        # Process each row in the master CSV
-        for row in reader:
-            suspended_value = row.get('suspended', '').strip().lower()
-            job_title = row.get('jobTitle', '').strip()
-            if suspended_value == 'true':
-                # Write to suspended users file
-                suspended_writer.writerow(row)
+# Output file paths per group of users
+split_csv_paths = {
+    'suspended': os.path.join(base_dir, '../../csv/user/split/split_suspended_google_users.csv'),
+    'leerling': os.path.join(base_dir, '../../csv/user/split/split_leerling_google_users.csv'),
+    'leerkracht': os.path.join(base_dir, '../../csv/user/split/split_leerkracht_google_users.csv'),
+    'administratie': os.path.join(base_dir, '../../csv/user/split/split_administratie_google_users.csv'),
+    'non_specific': os.path.join(base_dir, '../../csv/user/split/split_google_users.csv')
+}
+
+# Job titles per group of users
+leerkracht_job_titles = ['Leraar', 'Leraar LBV', 'Leraar LO', 'Zorgcoordinator']
+administratie_job_titles = ['Directeur', 'Administratief medewerker']
+
+def split_users(rows):
+    """
+    Splits merged user rows into suspended, leerling, leerkracht, administratie and non-specific users.
+    :return: Dictionary {group: [rows]} with the keys of split_csv_paths.
+    """
+    split = {group: [] for group in split_csv_paths}
+
+    # Process each row in the master data
+    for row in rows:
+        suspended_value = str(row.get('suspended', '')).strip().lower()
+        job_title = row.get('jobTitle', '').strip()
+        if suspended_value == 'true':
+            # Suspended users
+            split['suspended'].append(row)
+        else:
+            if job_title == 'Leerling':
+                split['leerling'].append(row)
+            elif job_title in leerkracht_job_titles:
+                split['leerkracht'].append(row)
+            elif job_title in administratie_job_titles:
+                split['administratie'].append(row)
             else:
-                if job_title == 'Leerling':
-                    leerling_writer.writerow(row)
-                elif job_title in ['Leraar', 'Leraar LBV', 'Leraar LO', 'Zorgcoordinator']:
-                    leerkracht_writer.writerow(row)
-                elif job_title in ['Directeur', 'Administratief medewerker']:
-                    administratie_writer.writerow(row)
-                else:
-                    non_specific_writer.writerow(row)
-
-print("CSV files have been split successfully.")
-print("Process finished --- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+                split['non_specific'].append(row)
+
+    return split
+
+def split_users_from_cache():
+    """
+    Splits the merged users of the directory cache with one indexed query per group of users,
+    with the same rules as split_users(). The cache stores the values trimmed and the booleans as 'True' or 'False',
+    so plain comparisons match what split_users() matches after strip() and lower().
+    :return: Dictionary {group: [rows]} with the keys of split_csv_paths.
+    """
+    suspended = f"suspended IN ({', '.join('?' for _ in true_values)})"
+    not_suspended = f"suspended NOT IN ({', '.join('?' for _ in true_values)})"
+    job_titles = {
+        'leerling': ['Leerling'],
+        'leerkracht': leerkracht_job_titles,
+        'administratie': administratie_job_titles
+    }
+    all_job_titles = [job_title for titles in job_titles.values() for job_title in titles]
+
+    split = {'suspended': select_rows('merged_users', suspended, true_values)}
+    for group, titles in job_titles.items():
+        in_titles = f"jobTitle IN ({', '.join('?' for _ in titles)})"
+        split[group] = select_rows('merged_users', f"{not_suspended} AND {in_titles}", (*true_values, *titles))
+    not_in_titles = f"jobTitle NOT IN ({', '.join('?' for _ in all_job_titles)})"
+    split['non_specific'] = select_rows('merged_users', f"{not_suspended} AND {not_in_titles}",
+                                        (*true_values, *all_job_titles))
+    return split
+
+def write_split_csvs(split, fieldnames):
+    """Writes every group of users to its own CSV file and snapshot."""
+    # Ensure the output directory exists
+    output_dir = os.path.dirname(split_csv_paths['suspended'])
+    os.makedirs(output_dir, exist_ok=True)
+
+    for group, rows in split.items():
+        with open(split_csv_paths[group], mode='w', newline='', encoding='utf-8') as split_file:
+            writer = csv.DictWriter(split_file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        write_snapshot(split_csv_paths[group], rows, fieldnames)
+
+def main(merged_users=None, write_csv=True):
+    """
+    Splits the merged user data per group of users.
+    :param merged_users: Rows from csv_user_data_merge.main(); selected from the directory cache, or read from
+                         merged_user_data.csv (or its snapshot) without a cache, if None.
+    :param write_csv: Also write each group to its split CSV file.
+    :return: Dictionary {group: [rows]}.
+    """
+    start_time = time.time()
+
+    # Without rows the header still has the merged columns, whichever way the users were read
+    if merged_users is None and has_table('merged_users'):
+        split = split_users_from_cache()
+        fieldnames = get_columns('merged_users')
+    else:
+        if merged_users is None:
+            merged_users = read_rows(master_csv_path)
+        fieldnames = list(merged_users[0].keys()) if merged_users else get_columns('merged_users')
+        split = split_users(merged_users)
+
+    if write_csv:
+        write_split_csvs(split, fieldnames)
+        print("CSV files have been split successfully.")
+
+    print("Process finished --- %s seconds ---" % (time.time() - start_time))
+    return split
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,19 @@
 import csv
 import os
 import time
-import json
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import build_fields_mask, get_service
+from directory_batch import execute_in_batches
+from directory_cache import load_table
+from directory_snapshot import get_directory_snapshot
+from paginator import iter_pages
+from snapshot_store import write_snapshot
 
-start_time = time.time()
-
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-# Retrieve configuration variables
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
 base_dir = os.path.join(os.path.dirname(__file__))
 
 # Scopes for reading user and role information from the directory
@@ -23,63 +22,75 @@ SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.rolemanagement.readonly'
 ]
 
-# Authenticate using the service account
-credentials = service_account.Credentials.from_service_account_file(
-    os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE),
-    scopes=SCOPES
-)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-
-# Build the Admin SDK service for managing users and roles
-service = build('admin', 'directory_v1', credentials=credentials)
-
-def get_all_google_users():
-    """Fetches all users from the domain."""
-    results = []
-    request = service.users().list(customer='my_customer', maxResults=500, orderBy='email')
-
-    while request is not None:
-        response = request.execute()
-        results.extend(response.get('users', []))
-        request = service.users().list_next(previous_request=request, previous_response=response)
-
-    return results
+def get_assigned_users(user_ids):
+    """
+    Looks up the users with the given ids: from the directory snapshot of google_user_data_pull.py where
+    it has them, and with batched users().get calls for the rest.
+    Ids that are not users, such as groups with a role, are left out.
+    :return: Dictionary {user id: {'primaryEmail', 'suspended', 'orgUnitPath'}}.
+    """
+    users_by_id = get_directory_snapshot().users_by_id
+    users = {user_id: users_by_id[user_id] for user_id in user_ids if user_id in users_by_id}
+    missing_ids = [user_id for user_id in user_ids if user_id not in users]
+
+    def on_result(user_id, response, exception):
+        if exception is None:
+            users[user_id] = response
+        elif not (isinstance(exception, HttpError) and exception.resp.status == 404):
+            print(f"Error retrieving user {user_id}: {exception}")
+
+    if missing_ids:
+        service = get_service(SCOPES)
+        requests = (
+            (user_id, service.users().get(userKey=user_id, projection='basic',
+                                          fields='id,primaryEmail,suspended,orgUnitPath'))
+            for user_id in missing_ids
+        )
+        execute_in_batches(service, requests, on_result)
+
+    print(f"Resolved {len(users)} assigned users ({len(user_ids) - len(missing_ids)} from the user snapshot)")
+    return users
 
 def get_admin_users():
     """Fetches all users with admin roles from the domain."""
+    service = get_service(SCOPES)
     admin_users = []
-    request = service.roleAssignments().list(customer='my_customer', maxResults=100)
+    request = service.roleAssignments().list(
+        customer='my_customer',
+        maxResults=100,
+        fields=build_fields_mask('items', ['assignedTo', 'roleId', 'scopeType'])
+    )
 
-    while request is not None:
-        response = request.execute()
-        admin_users.extend(response.get('items', []))
-        request = service.roleAssignments().list_next(previous_request=request, previous_response=response)
+    for role_assignments in iter_pages(service.roleAssignments(), request, 'items', SCOPES):
+        admin_users.extend(role_assignments)
 
     return admin_users
 
 def get_role_names():
     """Fetches all roles and their names from the domain."""
+    service = get_service(SCOPES)
     roles = {}
-    request = service.roles().list(customer='my_customer')
+    request = service.roles().list(customer='my_customer', fields=build_fields_mask('items', ['roleId', 'roleName']))
 
-    while request is not None:
-        response = request.execute()
-        for role in response.get('items', []):
+    for page in iter_pages(service.roles(), request, 'items', SCOPES):
+        for role in page:
             roles[role['roleId']] = role['roleName']
-        request = service.roles().list_next(previous_request=request, previous_response=response)
 
     return roles
 
 def write_admins_to_csv(admin_users, roles):
-    """Writes admin user data to a CSV file with UTF-8 encoding."""
+    """
+    Writes admin user data to a CSV file with UTF-8 encoding.
+    Only the users that have a role are looked up, not the whole directory.
+    """
     # Path to the CSV file in the csv folder
     csv_file_path = os.path.join(base_dir, '../../csv/user/core/admin_google_user_data.csv')
 
     # Define the CSV columns you want
     fields = ['roleName', 'userPrincipalName', 'suspended', 'userOrgUnitPath', 'roleScopeType']
 
-    # Fetch all users to get additional details
-    all_users = {user['id']: user for user in get_all_google_users()}
+    # Look up the assigned users to get additional details
+    all_users = get_assigned_users(list({admin['assignedTo'] for admin in admin_users if admin.get('assignedTo')}))
 
     admin_data_list = []
 
@@ -111,20 +122,31 @@ def write_admins_to_csv(admin_users, roles):
         writer.writeheader()
         writer.writerows(admin_data_list)
 
+    write_snapshot(csv_file_path, admin_data_list, fields)
+    load_table('roles', admin_data_list)
     print(f"CSV file written to: {csv_file_path}")
 
     # Count the number of unique users in the admin data list
     unique_users = {data['userPrincipalName'] for data in admin_data_list}
     print(f"{len(admin_data_list)} roles assigned to {len(unique_users)} unique users")
 
-if __name__ == "__main__":
-    # Fetch the role names
-    roles = get_role_names()
+def main():
+    """
+    Fetches all admin role assignments and writes them to admin_google_user_data.csv.
+    """
+    start_time = time.time()
 
-    # Fetch the admin user data
-    admin_users = get_admin_users()
+    # Fetch the role names and the role assignments at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        roles_future = executor.submit(get_role_names)
+        admin_users_future = executor.submit(get_admin_users)
+        roles = roles_future.result()
+        admin_users = admin_users_future.result()
 
     # Write the admin data to CSV
     write_admins_to_csv(admin_users, roles)
 
-print("Getting admin user data took --- %s seconds ---" % (time.time() - start_time))
+    print("Getting admin user data took --- %s seconds ---" % (time.time() - start_time))
+
+if __name__ == "__main__":
+    main()
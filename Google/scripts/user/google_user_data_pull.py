@@ -1,93 +1,186 @@
 import csv
 import os
 import time
-import json
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+import sys
 
-start_time = time.time()
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import build_fields_mask, get_service, load_config
+from directory_cache import load_table
+from directory_snapshot import get_directory_snapshot
+from paginator import iter_pages, merge_page_streams
+from snapshot_store import SnapshotWriter
 
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-# Retrieve configuration variables
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
 base_dir = os.path.join(os.path.dirname(__file__))
 
+# Path to the CSV file in the csv folder
+csv_file_path = os.path.join(base_dir, '../../csv/user/core/all_google_user_data.csv')
+
+# Define the CSV columns you want
+fields = [
+    'primaryEmail', 'firstName', 'lastName', 'orgUnitPath',
+    'lastLoginTime', 'suspended', 'isAdmin', 'updated', 'id'
+]
+
+# API field each CSV column is read from; 'updated' has no Directory API field and stays empty
+api_fields = {
+    'primaryEmail': 'primaryEmail',
+    'firstName': 'name/givenName',
+    'lastName': 'name/familyName',
+    'orgUnitPath': 'orgUnitPath',
+    'lastLoginTime': 'lastLoginTime',
+    'suspended': 'suspended',
+    'isAdmin': 'isAdmin',
+    'id': 'id'
+}
+
 # Scope for reading user information from the directory
 SCOPES = ['https://www.googleapis.com/auth/admin.directory.user.readonly']
 
-# Authenticate using the service account
-credentials = service_account.Credentials.from_service_account_file(
-    os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE),
-    scopes=SCOPES
-)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-
-# Build the Admin SDK service for managing users
-service = build('admin', 'directory_v1', credentials=credentials)
-
-def get_all_google_users():
-    """Fetches all users from the domain."""
-    results = []
+def get_user_shards():
+    """
+    Splits the user pull into shards that can be listed in parallel: one per domain, or one per email
+    prefix for the domains listed in USER_DOMAIN_QUERY_PREFIXES (config.json). The prefixes of a domain
+    must together cover the first character of every address in it.
+    Sharding is opt-in: the domains are taken from USER_DOMAINS in config.json, so no scope beyond SCOPES is needed.
+    :return: Dictionary {shard name: users().list arguments}, or None to list the whole customer at once.
+    """
+    config = load_config()
+    domains = config.get('USER_DOMAINS')
+    if not domains:
+        return None
+
+    query_prefixes = config.get('USER_DOMAIN_QUERY_PREFIXES', {})
+    shards = {}
+    for domain in domains:
+        if domain in query_prefixes:
+            for prefix in query_prefixes[domain]:
+                shards[f"{domain} ({prefix}*)"] = {'domain': domain, 'query': f"email:{prefix}*"}
+        else:
+            shards[domain] = {'domain': domain}
+    return shards
+
+def list_google_user_shard_pages(**list_arguments):
+    """
+    Fetches the users of one shard (or of the whole customer) page by page.
+    The next pages are fetched in the background while the current one is converted and written.
+    """
+    # Build the Admin SDK service for managing users
+    service = get_service(SCOPES)
     request = service.users().list(
-        customer='my_customer',
         maxResults=500,
         orderBy='email',
-        projection='full'  # Get all user attributes
+        projection='basic',  # The written columns are all basic attributes
+        fields=build_fields_mask('users', ['id'] + [api_fields[column] for column in fields if column in api_fields]),
+        **list_arguments
     )
 
-    while request is not None:
-        response = request.execute()
-        results.extend(response.get('users', []))
-        request = service.users().list_next(previous_request=request, previous_response=response)
-
-    return results
-
-def write_to_csv(users):
-    """Writes user data to a CSV file with UTF-8 encoding."""
-    # Path to the CSV file in the csv folder
-    csv_file_path = os.path.join(base_dir, '../../csv/user/core/all_google_user_data.csv')
-
-    # Ensure the directory exists
-    os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)
-
-    # Define the CSV columns you want
-    fields = [
-        'primaryEmail', 'firstName', 'lastName', 'orgUnitPath',
-        'lastLoginTime', 'suspended', 'isAdmin', 'updated'
-    ]
-    
-    # Open a CSV file to write with UTF-8 encoding
-    with open(csv_file_path, mode='w', newline='', encoding='utf-8') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=fields)
-        writer.writeheader()
-
-        for user in users:
-            # Parse user details
-            user_data = {
-                'primaryEmail': user.get('primaryEmail'),
-                'firstName': user['name'].get('givenName', ''),
-                'lastName': user['name'].get('familyName', ''),
-                'orgUnitPath': user.get('orgUnitPath', ''),
-                'lastLoginTime': user.get('lastLoginTime', 'Never'),
-                'suspended': user.get('suspended', False),
-                'isAdmin': user.get('isAdmin', False),
-                'updated': user.get('updated', '')
-            }
-            writer.writerow(user_data)
-
-    print(f"CSV file written to: {csv_file_path}")
+    yield from iter_pages(service.users(), request, 'users', SCOPES)
+
+def list_google_user_pages():
+    """
+    Fetches the users of all domains page by page, yielding each page as soon as it arrives.
+    The shards of get_user_shards() are listed in parallel (USER_SHARD_WORKERS in config.json, default 4).
+    Users returned by more than one shard are only yielded once.
+    """
+    shards = get_user_shards()
+    if not shards:
+        yield from list_google_user_shard_pages(customer='my_customer')
+        return
+
+    streams = {
+        name: lambda list_arguments=list_arguments: list_google_user_shard_pages(**list_arguments)
+        for name, list_arguments in shards.items()
+    }
+    seen_user_ids = set()
+    for _, google_users in merge_page_streams(streams, load_config().get('USER_SHARD_WORKERS', 4)):
+        new_users = [user for user in google_users if user['id'] not in seen_user_ids]
+        seen_user_ids.update(user['id'] for user in new_users)
+        yield new_users
+
+def parse_user(user):
+    """Converts a user from the API into a row with the CSV columns."""
+    return {
+        'primaryEmail': user.get('primaryEmail'),
+        'firstName': user.get('name', {}).get('givenName', ''),
+        'lastName': user.get('name', {}).get('familyName', ''),
+        'orgUnitPath': user.get('orgUnitPath', ''),
+        'lastLoginTime': user.get('lastLoginTime', 'Never'),
+        'suspended': user.get('suspended', False),
+        'isAdmin': user.get('isAdmin', False),
+        'updated': user.get('updated', ''),
+        'id': user.get('id', '')
+    }
+
+def stream_user_pages(write_csv=True):
+    """
+    Converts and writes the users page by page, so only one page of API responses is held at a time.
+    :param write_csv: Write every page to all_google_user_data.csv and its snapshot as soon as it is converted.
+    :return: Generator of (google_users, rows) tuples, one per page.
+    """
+    csv_file = None
+    snapshot = None
+    try:
+        if write_csv:
+            # Ensure the directory exists
+            os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)
+
+            # Open a CSV file to write with UTF-8 encoding
+            csv_file = open(csv_file_path, mode='w', newline='', encoding='utf-8')
+            writer = csv.DictWriter(csv_file, fieldnames=fields)
+            writer.writeheader()
+            snapshot = SnapshotWriter(csv_file_path, fields)
+
+        rows_written = 0
+        for google_users in list_google_user_pages():
+            rows = [parse_user(user) for user in google_users]
+            if csv_file is not None:
+                writer.writerows(rows)
+                snapshot.write_rows(rows)
+                rows_written += len(rows)
+                print(f"Written {rows_written} users so far")
+            yield google_users, rows
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+            snapshot.close()
+            print(f"CSV file written to: {csv_file_path}")
+
+def stream_users(write_csv=True):
+    """
+    Yields the user rows as their page arrives, for stages that can process users one at a time.
+    :param write_csv: Also write the rows to all_google_user_data.csv while streaming.
+    """
+    for _, rows in stream_user_pages(write_csv):
+        yield from rows
+
+def main(write_csv=True):
+    """
+    Pulls all Google users and returns them as rows with the CSV columns.
+    Only one page of API responses is held at a time, but every converted row is kept for the directory snapshot,
+    the cache and the merge, so memory grows with the number of users.
+    Use stream_users() instead to process the users one at a time while they are being pulled.
+    :param write_csv: Also write the rows to all_google_user_data.csv, page by page.
+    :return: List of user rows.
+    """
+    start_time = time.time()
+
+    # Fetch, convert and write the user data page by page
+    users = []
+    for _, rows in stream_user_pages(write_csv):
+        users.extend(rows)
+
+    if write_csv:
+        print(f"Successfully written {len(users)} users to all_google_user_data.csv")
+
+    # Later stages in this process look users up in the shared directory snapshot; reports query the cache,
+    # which is only loaded together with the CSV so the two never disagree
+    get_directory_snapshot().set_table('users', users)
+    if write_csv:
+        load_table('users', users)
+
+    print("Getting Google user data took --- %s seconds ---" % (time.time() - start_time))
+    return users
 
 if __name__ == "__main__":
-    # Fetch the user data
-    users = get_all_google_users()
-
-    # Write the data to CSV
-    write_to_csv(users)
-
-print(f"Successfully written {len(users)} users to all_google_user_data.csv")
-print("Getting Google user data took --- %s seconds ---" % (time.time() - start_time))
+    main()
@@ -1,40 +1,30 @@
 import os
-import csv
 import time
 import re
-import json
+import sys
 from collections import defaultdict
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 
-start_time = time.time()
-
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import get_service, load_config
+from directory_batch import move_users_in_batches
+from ou_index import get_ou_index
+from snapshot_store import read_rows
+from user_snapshot import fetch_live_user_state, get_user_state
 
 # Define base_dir for your CSV files
 base_dir = os.path.dirname(__file__)
 
-# Define the scope and credentials
+# Define the scopes
 SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.user', 
     'https://www.googleapis.com/auth/admin.directory.orgunit'
 ]
 
-credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-service = build('admin', 'directory_v1', credentials=credentials)
-
 # Path to your CSV file
 csv_file_path = os.path.join(base_dir, '../../csv/user/merged/merged_user_data.csv')
 
 # Initialize dictionaries to track users per domain (school)
-moved_users_count_per_school = defaultdict(int)
 ous_created_per_school = defaultdict(list)
 all_domains = set()  # To store all domains found in the CSV
 ou_check_cache = {}  # To store the OU check results per domain
@@ -66,7 +56,9 @@ def create_ou(ou_name, parent_ou, domain):
         "parentOrgUnitPath": parent_ou
     }
     try:
+        service = get_service(SCOPES)
         created_ou = service.orgunits().insert(customerId='my_customer', body=body).execute()
+        get_ou_index(service).add(created_ou)
         print(f"Created OU '{ou_name}' under '{parent_ou}'")
         ous_created_per_school[domain].append(f"{parent_ou}/{ou_name}")
         return created_ou
@@ -82,10 +74,9 @@ def check_ou_exists_or_create(domain, parent_ou, ou_to_check):
         return False
     
     try:
-        org_units = service.orgunits().list(customerId='my_customer', type='children', orgUnitPath=parent_ou).execute()
-        for ou in org_units.get('organizationUnits', []):
-            if ou['name'] == ou_to_check:
-                return True
+        # Look the OU up in the shared OU index instead of listing the parent's children
+        if get_ou_index(get_service(SCOPES)).has_child(parent_ou, ou_to_check):
+            return True
         create_ou(ou_to_check, parent_ou, domain)
         return True
     except Exception as e:
@@ -103,72 +94,88 @@ def check_and_create_required_ous():
         # Ensure '1.3Leerkracht' exists before moving users
         check_ou_exists_or_create(domain, f"{domain_ou_path}/1.Users", "1.3Leerkracht")
 
-# Step 1: Pre-scan the CSV file to gather only non-suspended users with specific job titles
-non_suspended_users = []
-target_job_titles = ["Leraar", "Leraar LBV", "Leraar LO"]  # Add any other relevant job titles
+def main(users=None):
+    """
+    Moves Leerkracht users to the '1.3Leerkracht' OU of their school.
+    :param users: Rows with the columns of merged_user_data.csv; read from that CSV if None.
+    """
+    start_time = time.time()
 
-with open(csv_file_path, mode='r') as file:
-    csv_reader = csv.DictReader(file)
-    
-    for row in csv_reader:
+    config = load_config()
+    service = get_service(SCOPES)
+
+    # Reset the tracking of a previous run in the same process
+    for tracker in (ous_created_per_school, all_domains, ou_check_cache, required_ous):
+        tracker.clear()
+
+    # Step 1: Pre-scan the users to gather only non-suspended users with specific job titles
+    # The decision is made from the pulled snapshot; set VERIFY_USER_SNAPSHOT in config.json to
+    # refresh suspended/orgUnitPath with one bulk users().list call instead.
+    live_user_state = fetch_live_user_state(service) if config.get('VERIFY_USER_SNAPSHOT', False) else None
+
+    non_suspended_users = []
+    target_job_titles = ["Leraar", "Leraar LBV", "Leraar LO"]  # Add any other relevant job titles
+
+    if users is None:
+        users = read_rows(csv_file_path)
+
+    for row in users:
         email = row['userPrincipalName']
         domain = row['userPrincipalName'].split('@')[1]
         job_title = row.get('jobTitle', '')
-        
-        try:
-            user = service.users().get(userKey=email).execute()
-            is_suspended = user.get('suspended', False)
-            
-            # Skip suspended users and check if the job title matches the target job titles
-            if not is_suspended and any(job in job_title for job in target_job_titles):
-                required_ous[domain].add("1.3Leerkracht")
-                non_suspended_users.append((email, domain))
-            else:
-                print(f"Skipping user {email} due to suspension or unmatched job title.")
-                
-            all_domains.add(domain)
-        except Exception as e:
-            print(f"Failed to fetch user {email}: {e}")
-
-# Step 2: Check and create all required OUs before moving users
-check_and_create_required_ous()
-
-# Step 3: Move users to the correct OU
-for email, domain in non_suspended_users:
-    target_ou = f"/@{domain}/1.Users/1.3Leerkracht"
-    
-    try:
-        user = service.users().get(userKey=email).execute()
-        current_ou = user.get('orgUnitPath', '')
-        
+
+        user = get_user_state(row, live_user_state)
+        if user is None:
+            print(f"Skipping user {email} because it no longer exists in Google.")
+            continue
+
+        # Skip suspended users and check if the job title matches the target job titles
+        if not user['suspended'] and any(job in job_title for job in target_job_titles):
+            required_ous[domain].add("1.3Leerkracht")
+            non_suspended_users.append((email, domain, user['orgUnitPath']))
+        else:
+            print(f"Skipping user {email} due to suspension or unmatched job title.")
+
+        all_domains.add(domain)
+
+    # Step 2: Check and create all required OUs before moving users
+    check_and_create_required_ous()
+
+    # Step 3: Collect the users that are not yet in the correct OU
+    pending_moves = []
+    for email, domain, current_ou in non_suspended_users:
+        target_ou = f"/@{domain}/1.Users/1.3Leerkracht"
+
         # Move the user if not already in the correct OU
         if current_ou != target_ou:
-            user_body = {
-                "orgUnitPath": target_ou
-            }
-            service.users().update(userKey=email, body=user_body).execute()
-            print(f'Successfully moved {email} to {target_ou}')
-            moved_users_count_per_school[domain] += 1
+            pending_moves.append((email, domain, target_ou))
         else:
             print(f'{email} is already in the correct OU. No action taken.')
-    
-    except Exception as e:
-        print(f'Failed to move {email}: {e}')
 
-# Output the final breakdown per school (domain)
-print("\nBreakdown of moved users per school:\n")
-for domain in all_domains:
-    moved_count = moved_users_count_per_school.get(domain, 0)
-    ous_created = ous_created_per_school.get(domain, [])
-    
-    print(f'School (Domain): {domain}')
-    print(f'  Total moved to "Leerkracht" OUs: {moved_count}')
-    
-    if ous_created:
-        print(f'  OUs created: {", ".join(ous_created)}')
-    else:
-        print(f'  No OUs created.')
-    
-    print('-' * 50)
+    # Step 4: Move the collected users in batches
+    moved_users_count_per_school, failed_users_per_school = move_users_in_batches(service, pending_moves)
+
+    # Output the final breakdown per school (domain)
+    print("\nBreakdown of moved users per school:\n")
+    for domain in all_domains:
+        moved_count = moved_users_count_per_school.get(domain, 0)
+        ous_created = ous_created_per_school.get(domain, [])
+
+        print(f'School (Domain): {domain}')
+        print(f'  Total moved to "Leerkracht" OUs: {moved_count}')
+
+        failed_users = failed_users_per_school.get(domain, [])
+        if failed_users:
+            print(f'  Failed to move: {", ".join(failed_users)}')
+
+        if ous_created:
+            print(f'  OUs created: {", ".join(ous_created)}')
+        else:
+            print(f'  No OUs created.')
+
+        print('-' * 50)
+
+    print(f"Process finished --- {time.time() - start_time} seconds ---")
 
-print(f"Process finished --- {time.time() - start_time} seconds ---")
+if __name__ == "__main__":
+    main()
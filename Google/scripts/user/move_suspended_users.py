@@ -1,63 +1,34 @@
 import os
-import csv
 import time
-import json
+import sys
 from collections import defaultdict
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 
-start_time = time.time()
-
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
-
-# Construct the full path to the service account file
-service_account_file_path = os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE)
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import get_service
+from directory_batch import move_users_in_batches
+from directory_cache import has_table, select_rows, true_values
+from ou_index import get_ou_index
+from snapshot_store import read_rows
 
 # Define base_dir for your CSV files
 base_dir = os.path.dirname(__file__)
 
-# Define the scope and credentials
+# Define the scopes
 SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.user',
     'https://www.googleapis.com/auth/admin.directory.orgunit'
 ]
 
-credentials = service_account.Credentials.from_service_account_file(service_account_file_path, scopes=SCOPES)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-service = build('admin', 'directory_v1', credentials=credentials, cache_discovery=False)
-
 # Path to your CSV file
 csv_file_path = os.path.join(base_dir, '../../csv/user/split/split_suspended_google_users.csv')
 
 # Initialize dictionaries to track suspended and moved users per domain (school)
 suspended_users_count_per_school = defaultdict(int)
-moved_users_count_per_school = defaultdict(int)
 ous_created_per_school = defaultdict(list)
 all_domains = set()  # To store all domains found in the CSV
 ou_check_cache = {}  # To store the OU check results per domain
-
-# Precheck: Only gather users who are suspended and not already in the suspended OU
-suspended_users = []
-
-with open(csv_file_path, mode='r') as file:
-    csv_reader = csv.DictReader(file)
-    for row in csv_reader:
-        if row['suspended'].lower() == 'true':
-            # Skip users who are already in the suspended OU
-            if "/1.Users/1.6Suspended" not in row['orgUnitPath']:
-                suspended_users.append(row)
-
-# If no suspended users are found, output a message and skip further processing
-if not suspended_users:
-    print("No suspended users found or all users are already in the suspended OU.")
-else:
-    print(f"Processing {len(suspended_users)} suspended users...")  # Debugging print
+pending_moves = []  # Users that need to move, sent in batches afterwards
 
 def create_ou(ou_name, parent_ou, domain):
     """
@@ -68,27 +39,28 @@ def create_ou(ou_name, parent_ou, domain):
         "parentOrgUnitPath": parent_ou
     }
     try:
+        service = get_service(SCOPES)
         created_ou = service.orgunits().insert(customerId='my_customer', body=body).execute()
+        get_ou_index(service).add(created_ou)
         ous_created_per_school[domain].append(f"{parent_ou}/{ou_name}")  # Track the created OU
         return created_ou
     except Exception as e:
         print(f"Failed to create OU '{ou_name}' under '{parent_ou}': {e}")
-        raise e  # Re-raise the exception to trigger retry
+        raise e  # Quota errors were already retried by the rate limiter, so report the failure
 
 def check_ou_exists_or_create(domain, parent_ou, ou_to_check):
     """
     Check if the given OU exists under the parent OU for the domain, or create it if it doesn't exist.
     """
     try:
-        org_units = service.orgunits().list(customerId='my_customer', type='children', orgUnitPath=parent_ou).execute()
-        for ou in org_units.get('organizationUnits', []):
-            if ou['name'] == ou_to_check:
-                return True
+        # Look the OU up in the shared OU index instead of listing the parent's children
+        if get_ou_index(get_service(SCOPES)).has_child(parent_ou, ou_to_check):
+            return True
         create_ou(ou_to_check, parent_ou, domain)
         return True
     except Exception as e:
         print(f"Failed to check or create OU '{ou_to_check}' for domain {domain}: {e}")
-        raise e  # Re-raise the exception so that tenacity knows to retry
+        raise e  # Quota errors were already retried by the rate limiter, so report the failure
 
 def check_required_ous_or_create(domain):
     """
@@ -117,7 +89,7 @@ def check_required_ous_or_create(domain):
 
 def process_user(user_data):
     """
-    Process an individual user: check if they need to be moved and move them if necessary.
+    Process an individual user: check if they need to be moved and queue them for the batched move.
     """
     email = user_data['userPrincipalName']
     domain = email.split('@')[1]
@@ -137,38 +109,79 @@ def process_user(user_data):
     if current_ou == target_ou:
         return
     
-    try:
-        # Move the user to the suspended OU
-        user_body = {"orgUnitPath": target_ou}
-        service.users().update(userKey=email, body=user_body).execute()
-        moved_users_count_per_school[domain] += 1
-    
-    except Exception as e:
-        print(f'Failed to move {email}: {e}')
-
-# Process each suspended user sequentially
-for user_data in suspended_users:
-    process_user(user_data)
-
-# Output the final breakdown per school (domain)
-if not all_domains:
-    print("No domains found or all users are already in the suspended OU")
-else:
-    print("\nBreakdown of suspended and moved users per school:\n")
-    for domain in all_domains:
-        suspended_count = suspended_users_count_per_school.get(domain, 0)
-        moved_count = moved_users_count_per_school.get(domain, 0)
-        ous_created = ous_created_per_school.get(domain, [])
-        
-        print(f'School (Domain): {domain}')
-        print(f'  Total suspended users: {suspended_count}')
-        print(f'  Total moved to suspended OU: {moved_count}')
-        
-        if ous_created:
-            print(f'  OUs created: {", ".join(ous_created)}')
-        else:
-            print(f'  No OUs created.')
-        
-        print('-' * 50)
-
-print("Process finished --- %s seconds ---" % (time.time() - start_time))
+    # Queue the user for the batched move to the suspended OU
+    pending_moves.append((email, domain, target_ou))
+
+def main(users=None):
+    """
+    Moves suspended users to the '1.6Suspended' OU of their school.
+    :param users: Rows from csv_user_data_splitting.main()['suspended']; selected from the directory cache, or read
+                  from the split CSV without a cache, if None.
+    :return: List of the emails of the users that failed to move.
+    """
+    start_time = time.time()
+
+    # Reset the tracking of a previous run in the same process
+    for tracker in (suspended_users_count_per_school, ous_created_per_school, all_domains, ou_check_cache, pending_moves):
+        tracker.clear()
+
+    if users is None and has_table('merged_users'):
+        # Select the suspended users outside the suspended OU with an indexed query on the directory cache;
+        # instr() compares case-sensitively like the precheck below, where LIKE would not
+        users = select_rows('merged_users',
+                            f"suspended IN ({', '.join('?' for _ in true_values)}) AND instr(orgUnitPath, ?) = 0",
+                            (*true_values, '/1.Users/1.6Suspended'))
+    elif users is None:
+        users = read_rows(csv_file_path)
+
+    # Precheck: Only gather users who are suspended and not already in the suspended OU
+    suspended_users = []
+    for row in users:
+        if row['suspended'].strip().lower() == 'true':
+            # Skip users who are already in the suspended OU
+            if "/1.Users/1.6Suspended" not in row['orgUnitPath']:
+                suspended_users.append(row)
+
+    # If no suspended users are found, output a message and skip further processing
+    if not suspended_users:
+        print("No suspended users found or all users are already in the suspended OU.")
+    else:
+        print(f"Processing {len(suspended_users)} suspended users...")  # Debugging print
+
+    # Check each suspended user and collect the ones that need to move
+    for user_data in suspended_users:
+        process_user(user_data)
+
+    # Move the collected users in batches
+    moved_users_count_per_school, failed_users_per_school = move_users_in_batches(get_service(SCOPES), pending_moves)
+
+    # Output the final breakdown per school (domain)
+    if not all_domains:
+        print("No domains found or all users are already in the suspended OU")
+    else:
+        print("\nBreakdown of suspended and moved users per school:\n")
+        for domain in all_domains:
+            suspended_count = suspended_users_count_per_school.get(domain, 0)
+            moved_count = moved_users_count_per_school.get(domain, 0)
+            ous_created = ous_created_per_school.get(domain, [])
+
+            print(f'School (Domain): {domain}')
+            print(f'  Total suspended users: {suspended_count}')
+            print(f'  Total moved to suspended OU: {moved_count}')
+
+            failed_users = failed_users_per_school.get(domain, [])
+            if failed_users:
+                print(f'  Failed to move: {", ".join(failed_users)}')
+
+            if ous_created:
+                print(f'  OUs created: {", ".join(ous_created)}')
+            else:
+                print(f'  No OUs created.')
+
+            print('-' * 50)
+
+    print("Process finished --- %s seconds ---" % (time.time() - start_time))
+    return [email for failed_users in failed_users_per_school.values() for email in failed_users]
+
+if __name__ == "__main__":
+    main()
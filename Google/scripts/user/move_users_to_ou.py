@@ -1,35 +1,23 @@
 import os
-import csv
 import time
 import re
-import json
+import sys
 from collections import defaultdict
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 
-start_time = time.time()
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import get_service, load_config
+from directory_batch import move_users_in_batches
+from ou_index import get_ou_index
+from snapshot_store import read_rows
+from user_snapshot import fetch_live_user_state, get_user_state
 
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
-
-# Define the scope and credentials
+# Define the scopes
 SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.user',
     'https://www.googleapis.com/auth/admin.directory.orgunit'
 ]
 
-credentials = service_account.Credentials.from_service_account_file(
-    os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE),
-    scopes=SCOPES
-)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-service = build('admin', 'directory_v1', credentials=credentials)
-
 # Define base_dir for your CSV files
 base_dir = os.path.dirname(__file__)
 
@@ -37,7 +25,6 @@ base_dir = os.path.dirname(__file__)
 csv_file_path = os.path.join(base_dir, '../../csv/user/merged/merged_user_data.csv')
 
 # Initialize dictionaries to track users per domain (school)
-moved_users_count_per_school = defaultdict(int)
 ous_created_per_school = defaultdict(list)
 all_domains = set()  # To store all domains found in the CSV
 ou_check_cache = {}  # To store the OU check results per domain
@@ -69,7 +56,9 @@ def create_ou(ou_name, parent_ou, domain):
         "parentOrgUnitPath": parent_ou
     }
     try:
+        service = get_service(SCOPES)
         created_ou = service.orgunits().insert(customerId='my_customer', body=body).execute()
+        get_ou_index(service).add(created_ou)
         print(f"Created OU '{ou_name}' under '{parent_ou}'")
         ous_created_per_school[domain].append(f"{parent_ou}/{ou_name}")
         return created_ou
@@ -86,12 +75,10 @@ def check_ou_exists_or_create(domain, parent_ou, ou_to_check):
         return False
     
     try:
-        # List all org units under the parent OU
-        org_units = service.orgunits().list(customerId='my_customer', type='children', orgUnitPath=parent_ou).execute()
-        for ou in org_units.get('organizationUnits', []):
-            if ou['name'] == ou_to_check:
-                print(f"OU '{ou_to_check}' already exists under '{parent_ou}'")
-                return True
+        # Look the OU up in the shared OU index instead of listing the parent's children
+        if get_ou_index(get_service(SCOPES)).has_child(parent_ou, ou_to_check):
+            print(f"OU '{ou_to_check}' already exists under '{parent_ou}'")
+            return True
         
         # If OU does not exist, create it
         create_ou(ou_to_check, parent_ou, domain)
@@ -133,106 +120,106 @@ def check_and_create_required_ous():
             else:
                 print(f"Skipping empty department OU creation for domain {domain}")
 
-# Step 1: Pre-scan the CSV file to gather only non-suspended users with specific job titles
-non_suspended_users_leerkracht = []
-non_suspended_users_administratie = []
-non_suspended_users_leerling = []
+def main(users=None):
+    """
+    Moves Leerkracht, Administratie and Leerling users to their OU, creating missing OUs.
+    :param users: Rows with the columns of merged_user_data.csv; read from that CSV if None.
+    :return: List of the emails of the users that failed to move.
+    """
+    start_time = time.time()
+
+    config = load_config()
+    service = get_service(SCOPES)
+
+    # Reset the tracking of a previous run in the same process
+    for tracker in (ous_created_per_school, all_domains, ou_check_cache, required_ous):
+        tracker.clear()
+
+    # Step 1: Pre-scan the users to gather only non-suspended users with specific job titles
+    # The decision is made from the pulled snapshot; set VERIFY_USER_SNAPSHOT in config.json to
+    # refresh suspended/orgUnitPath with one bulk users().list call instead.
+    live_user_state = fetch_live_user_state(service) if config.get('VERIFY_USER_SNAPSHOT', False) else None
 
-target_job_titles_leerkracht = ["Leraar", "Leraar LBV", "Leraar LO", "Zorgcoordinator"]
-target_job_titles_administratie = ["Directeur", "Administratief medewerker"]
+    non_suspended_users_leerkracht = []
+    non_suspended_users_administratie = []
+    non_suspended_users_leerling = []
 
-with open(csv_file_path, mode='r') as file:
-    csv_reader = csv.DictReader(file)
-    for row in csv_reader:
+    target_job_titles_leerkracht = ["Leraar", "Leraar LBV", "Leraar LO", "Zorgcoordinator"]
+    target_job_titles_administratie = ["Directeur", "Administratief medewerker"]
+
+    if users is None:
+        users = read_rows(csv_file_path)
+
+    for row in users:
         email = row['userPrincipalName']
         domain = email.split('@')[1]
         job_title = row.get('jobTitle', '')
         department = row.get('department', '')
-        try:
-            user = service.users().get(userKey=email).execute()
-            is_suspended = user.get('suspended', False)
-            if not is_suspended:
-                if any(job in job_title for job in target_job_titles_leerkracht):
-                    required_ous[domain].add("1.3Leerkracht")
-                    non_suspended_users_leerkracht.append((email, domain))
-                elif any(job in job_title for job in target_job_titles_administratie):
-                    required_ous[domain].add("1.2Administratie")
-                    non_suspended_users_administratie.append((email, domain))
-                elif job_title == "Leerling" and department:
-                    sanitized_department = sanitize_ou_name(department)
-                    required_ous[domain].add(sanitized_department)
-                    non_suspended_users_leerling.append((email, domain, sanitized_department))
-                else:
-                    print(f"Skipping user {email} due to unmatched job title.")
+        user = get_user_state(row, live_user_state)
+        if user is None:
+            print(f"Skipping user {email} because it no longer exists in Google.")
+            continue
+        current_ou = user['orgUnitPath']
+        if not user['suspended']:
+            if any(job in job_title for job in target_job_titles_leerkracht):
+                required_ous[domain].add("1.3Leerkracht")
+                non_suspended_users_leerkracht.append((email, domain, current_ou))
+            elif any(job in job_title for job in target_job_titles_administratie):
+                required_ous[domain].add("1.2Administratie")
+                non_suspended_users_administratie.append((email, domain, current_ou))
+            elif job_title == "Leerling" and department:
+                sanitized_department = sanitize_ou_name(department)
+                required_ous[domain].add(sanitized_department)
+                non_suspended_users_leerling.append((email, domain, sanitized_department, current_ou))
             else:
-                print(f"Skipping user {email} due to suspension.")
-            all_domains.add(domain)
-        except Exception as e:
-            print(f"Failed to fetch user {email}: {e}")
+                print(f"Skipping user {email} due to unmatched job title.")
+        else:
+            print(f"Skipping user {email} due to suspension.")
+        all_domains.add(domain)
 
-# Step 2: Check and create all required OUs before moving users
-check_and_create_required_ous()
+    # Step 2: Check and create all required OUs before moving users
+    check_and_create_required_ous()
 
-# Step 3: Move users to the correct OU for Leerkracht
-for email, domain in non_suspended_users_leerkracht:
-    target_ou = f"/@{domain}/1.Users/1.3Leerkracht"
-    try:
-        user = service.users().get(userKey=email).execute()
-        current_ou = user.get('orgUnitPath', '')
-        if current_ou != target_ou:
-            user_body = {"orgUnitPath": target_ou}
-            service.users().update(userKey=email, body=user_body).execute()
-            print(f'Successfully moved {email} to {target_ou}')
-            moved_users_count_per_school[domain] += 1
-        else:
-            print(f'{email} is already in the correct OU. No action taken.')
-    except Exception as e:
-        print(f'Failed to move {email} to {target_ou}: {e}')
+    # Step 3: Collect the users that are not yet in the correct OU
+    pending_moves = []
 
-# Step 4: Move users to the correct OU for Administratie
-for email, domain in non_suspended_users_administratie:
-    target_ou = f"/@{domain}/1.Users/1.2Administratie"
-    try:
-        user = service.users().get(userKey=email).execute()
-        current_ou = user.get('orgUnitPath', '')
+    def queue_move_if_needed(email, domain, current_ou, target_ou):
+        """Queue the user for a move if they are not already in the target OU."""
         if current_ou != target_ou:
-            user_body = {"orgUnitPath": target_ou}
-            service.users().update(userKey=email, body=user_body).execute()
-            print(f'Successfully moved {email} to {target_ou}')
-            moved_users_count_per_school[domain] += 1
+            pending_moves.append((email, domain, target_ou))
         else:
             print(f'{email} is already in the correct OU. No action taken.')
-    except Exception as e:
-        print(f'Failed to move {email}: {e}')
 
-# Step 5: Move users to the correct OU for Leerling
-for email, domain, department in non_suspended_users_leerling:
-    target_ou = f"/@{domain}/1.Users/1.4Leerling/{department}"
-    try:
-        user = service.users().get(userKey=email).execute()
-        current_ou = user.get('orgUnitPath', '')
-        if current_ou != target_ou:
-            user_body = {"orgUnitPath": target_ou}
-            service.users().update(userKey=email, body=user_body).execute()
-            print(f'Successfully moved {email} to {target_ou}')
-            moved_users_count_per_school[domain] += 1
+    for email, domain, current_ou in non_suspended_users_leerkracht:
+        queue_move_if_needed(email, domain, current_ou, f"/@{domain}/1.Users/1.3Leerkracht")
+
+    for email, domain, current_ou in non_suspended_users_administratie:
+        queue_move_if_needed(email, domain, current_ou, f"/@{domain}/1.Users/1.2Administratie")
+
+    for email, domain, department, current_ou in non_suspended_users_leerling:
+        queue_move_if_needed(email, domain, current_ou, f"/@{domain}/1.Users/1.4Leerling/{department}")
+
+    # Step 4: Move the queued users in batches
+    moved_users_count_per_school, failed_users_per_school = move_users_in_batches(service, pending_moves)
+
+    # Output the final breakdown per school (domain)
+    print("\nBreakdown of moved users per school:\n")
+    for domain in all_domains:
+        moved_count = moved_users_count_per_school.get(domain, 0)
+        ous_created = ous_created_per_school.get(domain, [])
+        print(f'School (Domain): {domain}')
+        print(f'  Total moved to OUs: {moved_count}')
+        failed_users = failed_users_per_school.get(domain, [])
+        if failed_users:
+            print(f'  Failed to move: {", ".join(failed_users)}')
+        if ous_created:
+            print(f'  OUs created: {", ".join(ous_created)}')
         else:
-            print(f'{email} is already in the correct OU. No action taken.')
-    except Exception as e:
-        print(f'Failed to move {email} to {target_ou}: {e}')
-
-
-# Output the final breakdown per school (domain)
-print("\nBreakdown of moved users per school:\n")
-for domain in all_domains:
-    moved_count = moved_users_count_per_school.get(domain, 0)
-    ous_created = ous_created_per_school.get(domain, [])
-    print(f'School (Domain): {domain}')
-    print(f'  Total moved to OUs: {moved_count}')
-    if ous_created:
-        print(f'  OUs created: {", ".join(ous_created)}')
-    else:
-        print(f'  No OUs created.')
-    print('-' * 50)
+            print(f'  No OUs created.')
+        print('-' * 50)
+
+    print(f"Process finished --- {time.time() - start_time} seconds ---")
+    return [email for failed_users in failed_users_per_school.values() for email in failed_users]
 
-print(f"Process finished --- {time.time() - start_time} seconds ---")
+if __name__ == "__main__":
+    main()
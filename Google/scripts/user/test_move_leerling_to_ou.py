@@ -1,46 +1,30 @@
 import os
-import csv
 import time
 import re
-import json
-import urllib.parse
+import sys
 from collections import defaultdict
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 
-start_time = time.time()
-
-# Load configuration from config.json
-config_path = os.path.join(os.path.dirname(__file__), '../../service/config.json')
-with open(config_path, 'r') as config_file:
-    config = json.load(config_file)
-
-SERVICE_ACCOUNT_FILE = config.get('SERVICE_ACCOUNT_FILE')
-DELEGATED_ADMIN_EMAIL = config.get('DELEGATED_ADMIN_EMAIL')
-
-# Construct the full path to the service account file
-service_account_file_path = os.path.join(os.path.dirname(__file__), '../../service', SERVICE_ACCOUNT_FILE)
+# Shared helpers live next to config.json in Google/service
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../service'))
+from admin_client import get_service, load_config
+from directory_batch import move_users_in_batches
+from ou_index import get_ou_index
+from snapshot_store import read_rows
+from user_snapshot import fetch_live_user_state, get_user_state
 
 # Define base_dir for your CSV files
 base_dir = os.path.dirname(__file__)
 
-# Define the scope and credentials
+# Define the scopes
 SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.user',
     'https://www.googleapis.com/auth/admin.directory.orgunit'
 ]
 
-credentials = service_account.Credentials.from_service_account_file(
-    service_account_file_path, scopes=SCOPES)
-credentials = credentials.with_subject(DELEGATED_ADMIN_EMAIL)
-
-service = build('admin', 'directory_v1', credentials=credentials)
-
 # Path to your CSV file
 csv_file_path = os.path.join(base_dir, '../../csv/user/split/split_leerling_google_users.csv')
 
 # Initialize dictionaries to track users per domain (school)
-moved_users_count_per_school = defaultdict(int)
 ous_created_per_school = defaultdict(list)
 all_domains = set()  # To store all domains found in the CSV
 
@@ -73,19 +57,12 @@ def ensure_ou_path_exists(ou_path, domain):
     parts = ou_path.strip('/').split('/')
     current_path = ''
     for part in parts:
+        parent_path = current_path or '/'
         current_path += f'/{part}'
-        try:
-            encoded_current_path = urllib.parse.quote(current_path, safe='')
-            service.orgunits().get(customerId='my_customer', orgUnitPath=encoded_current_path).execute()
-            # OU exists
-        except Exception as e:
-            if 'not found' in str(e).lower():
-                # Parent OU exists, create this OU
-                parent_path = '/' + '/'.join(current_path.strip('/').split('/')[:-1])
-                ou_name = current_path.strip('/').split('/')[-1]
-                create_ou(ou_name, parent_path, domain)
-            else:
-                print(f"Error checking OU '{current_path}': {e}")
+        # Look the OU up in the shared OU index instead of calling orgunits().get per path segment
+        if not get_ou_index(get_service(SCOPES)).exists(current_path):
+            # Parent OU exists, create this OU
+            create_ou(part, parent_path, domain)
 
 def create_ou(ou_name, parent_ou, domain):
     """
@@ -106,7 +83,9 @@ def create_ou(ou_name, parent_ou, domain):
         "parentOrgUnitPath": parent_ou
     }
     try:
+        service = get_service(SCOPES)
         created_ou = service.orgunits().insert(customerId='my_customer', body=body).execute()
+        get_ou_index(service).add(created_ou)
         print(f"Created OU '{ou_name}' under '{parent_ou}'")
         ous_created_per_school[domain].append(f"{parent_ou}/{ou_name}")
         return created_ou
@@ -117,67 +96,90 @@ def create_ou(ou_name, parent_ou, domain):
             print(f"Failed to create OU '{ou_name}' under '{parent_ou}': {e}")
         return None
 
-# Step 1: Read the CSV file and gather user information
-users_to_process = []
+def main(users=None):
+    """
+    Moves Leerling users to the OU of their class, creating missing OUs.
+    :param users: Rows with the columns of split_leerling_google_users.csv; read from that CSV if None.
+    """
+    start_time = time.time()
+
+    config = load_config()
+    service = get_service(SCOPES)
+
+    # Reset the tracking of a previous run in the same process
+    for tracker in (ous_created_per_school, all_domains, required_ous):
+        tracker.clear()
 
-with open(csv_file_path, mode='r') as file:
-    csv_reader = csv.DictReader(file)
+    # Step 1: Read the users and gather user information
+    # The current OU is taken from the pulled snapshot; set VERIFY_USER_SNAPSHOT in config.json to
+    # refresh it with one bulk users().list call instead.
+    live_user_state = fetch_live_user_state(service) if config.get('VERIFY_USER_SNAPSHOT', False) else None
 
-    for row in csv_reader:
+    users_to_process = []
+
+    if users is None:
+        users = read_rows(csv_file_path)
+
+    for row in users:
         email = row['userPrincipalName']
         domain = email.split('@')[1]  # This represents the school in your case
         department = row.get('department', '')  # Get the department (class) information
 
+        user = get_user_state(row, live_user_state)
+        if user is None:
+            print(f"Skipping user {email} because it no longer exists in Google.")
+            continue
+
         sanitized_department = sanitize_ou_name(department)
         if sanitized_department:
             required_ous[domain].add(sanitized_department)
-            users_to_process.append((email, domain, sanitized_department))
+            users_to_process.append((email, domain, sanitized_department, user['orgUnitPath']))
         else:
             print(f"Skipping user {email} due to invalid department.")
 
         all_domains.add(domain)
 
-# Step 2: Check and create all required OUs before moving users
-for domain, departments in required_ous.items():
-    for department in departments:
-        ou_path = f'/@{domain}/1.Users/1.4Leerling/{department}'
-        ensure_ou_path_exists(ou_path, domain)
+    # Step 2: Check and create all required OUs before moving users
+    for domain, departments in required_ous.items():
+        for department in departments:
+            ou_path = f'/@{domain}/1.Users/1.4Leerling/{department}'
+            ensure_ou_path_exists(ou_path, domain)
 
-# Step 3: Move users to their respective OUs if they are not already there
-for email, domain, department in users_to_process:
-    target_ou = f'/@{domain}/1.Users/1.4Leerling/{department}'
-    try:
-        user = service.users().get(userKey=email).execute()
-        current_ou = user.get('orgUnitPath', '')  # Get the current OU path
+    # Step 3: Collect the users that are not yet in their respective OUs
+    pending_moves = []
+    for email, domain, department, current_ou in users_to_process:
+        target_ou = f'/@{domain}/1.Users/1.4Leerling/{department}'
 
         # Only move the user if they are not already in the target OU
         if current_ou != target_ou:
-            user_body = {
-                "orgUnitPath": target_ou
-            }
-            service.users().update(userKey=email, body=user_body).execute()
-            print(f'Successfully moved {email} to {target_ou}')
-            moved_users_count_per_school[domain] += 1
+            pending_moves.append((email, domain, target_ou))
         else:
             print(f'{email} is already in the correct OU. No action taken.')
 
-    except Exception as e:
-        print(f'Failed to process {email}: {e}')
+    # Step 4: Move the collected users in batches
+    moved_users_count_per_school, failed_users_per_school = move_users_in_batches(service, pending_moves)
 
-# Output the final breakdown per school (domain)
-print("\nBreakdown of moved users per school:\n")
-for domain in all_domains:
-    moved_count = moved_users_count_per_school.get(domain, 0)
-    ous_created = ous_created_per_school.get(domain, [])
+    # Output the final breakdown per school (domain)
+    print("\nBreakdown of moved users per school:\n")
+    for domain in all_domains:
+        moved_count = moved_users_count_per_school.get(domain, 0)
+        ous_created = ous_created_per_school.get(domain, [])
 
-    print(f'School (Domain): {domain}')
-    print(f'  Total moved to "Leerling" OUs: {moved_count}')
+        print(f'School (Domain): {domain}')
+        print(f'  Total moved to "Leerling" OUs: {moved_count}')
 
-    if ous_created:
-        print(f'  OUs created: {", ".join(ous_created)}')
-    else:
-        print(f'  No OUs created.')
+        failed_users = failed_users_per_school.get(domain, [])
+        if failed_users:
+            print(f'  Failed to move: {", ".join(failed_users)}')
+
+        if ous_created:
+            print(f'  OUs created: {", ".join(ous_created)}')
+        else:
+            print(f'  No OUs created.')
+
+        print('-' * 50)
 
-    print('-' * 50)
+    print(f"Process finished --- {time.time() - start_time} seconds ---")
 
-print(f"Process finished --- {time.time() - start_time} seconds ---")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
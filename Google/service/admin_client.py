@@ -0,0 +1,88 @@
+import os
+import json
+import threading
+from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import build_http
+from rate_limiter import RateLimitedHttpRequest
+
+# Directory holding config.json and the service account key file
+service_dir = os.path.dirname(os.path.abspath(__file__))
+config_path = os.path.join(service_dir, 'config.json')
+
+_config = None
+_discovery_document = None
+_credentials_per_scopes = {}
+_lock = threading.Lock()
+# Resource objects are cached per thread because the underlying httplib2 connection is not thread-safe
+_thread_local = threading.local()
+
+def load_config():
+    """
+    Loads config.json once per process and returns the parsed configuration.
+    """
+    global _config
+    if _config is None:
+        with open(config_path, 'r') as config_file:
+            _config = json.load(config_file)
+    return _config
+
+def get_credentials(scopes):
+    """
+    Returns delegated service account credentials for the given scopes.
+    Credentials are created once per set of scopes and reused for the rest of the process.
+    """
+    key = frozenset(scopes)
+    with _lock:
+        if key not in _credentials_per_scopes:
+            config = load_config()
+            # Relative key file paths are resolved against the service directory
+            service_account_file = os.path.join(service_dir, config.get('SERVICE_ACCOUNT_FILE'))
+            credentials = service_account.Credentials.from_service_account_file(
+                service_account_file, scopes=sorted(key))
+            _credentials_per_scopes[key] = credentials.with_subject(config.get('DELEGATED_ADMIN_EMAIL'))
+        return _credentials_per_scopes[key]
+
+def get_discovery_document():
+    """
+    Returns the Admin SDK Directory discovery document bundled with google-api-python-client.
+    It is parsed once per process, so no discovery request is made when building services.
+    """
+    global _discovery_document
+    with _lock:
+        if _discovery_document is None:
+            _discovery_document = json.loads(get_static_doc('admin', 'directory_v1'))
+        return _discovery_document
+
+def new_http(scopes):
+    """
+    Returns a new authorized HTTP connection for the given scopes, for requests executed on another thread.
+    """
+    return AuthorizedHttp(get_credentials(scopes), http=build_http())
+
+def build_fields_mask(collection, field_paths):
+    """
+    Builds a partial-response fields= mask for a list call, e.g. 'nextPageToken,users(primaryEmail,name/givenName)'.
+    :param collection: Name of the list in the response, such as 'users' or 'chromeosdevices'.
+    :param field_paths: API fields to return for every item, with '/' for nested fields.
+    """
+    return f"nextPageToken,{collection}({','.join(dict.fromkeys(field_paths))})"
+
+def get_service(scopes):
+    """
+    Returns an Admin SDK Directory service for the given scopes.
+    The service is built on first use and reused for later calls from the same thread.
+    Its JSON model sends 'Accept-Encoding: gzip' with a '(gzip)' user-agent, so responses come back compressed.
+    Every request of the service goes through the rate limiter of its API family (see rate_limiter.py).
+    """
+    services = getattr(_thread_local, 'services', None)
+    if services is None:
+        services = _thread_local.services = {}
+
+    key = frozenset(scopes)
+    if key not in services:
+        services[key] = build_from_document(get_discovery_document(), credentials=get_credentials(scopes),
+                                             requestBuilder=RateLimitedHttpRequest)
+    return services[key]
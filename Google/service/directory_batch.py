@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from admin_client import get_service
+from rate_limiter import (MAX_RETRIES, get_backoff_seconds, get_family, get_rate_limiter,
+                          is_quota_error, is_transient_error)
+
+def execute_in_batches(service, requests, on_result, batch_size=None):
+    """
+    Sends (key, request) pairs to the Directory API as batch HTTP requests.
+    Batches go through the rate limiter of the requests' API family. Requests of a batch that fail on
+    quota or server errors are retried in a later batch after a backoff; the rest are reported.
+    :param service: The Admin SDK Directory service.
+    :param requests: Iterable of (key, HttpRequest) tuples.
+    :param on_result: Called as on_result(key, response, exception) once per request.
+    :param batch_size: Maximum number of requests per batch; the rate limiter's adaptive batch size if None.
+    """
+    pending = []  # (key, request, attempt)
+
+    def flush():
+        while pending:
+            limiter = get_rate_limiter(get_family(pending[0][1]))
+            entries = {}
+            retries = []
+            quota_errors = []
+
+            def callback(request_id, response, exception):
+                key, request, attempt = entries.pop(request_id)
+                retryable = is_quota_error(exception) or is_transient_error(exception)
+                if exception is not None and retryable and attempt < MAX_RETRIES:
+                    retries.append((key, request, attempt + 1))
+                    if is_quota_error(exception):
+                        quota_errors.append(key)
+                else:
+                    on_result(key, response, exception)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for index, entry in enumerate(pending):
+                entries[str(index)] = entry
+                batch.add(entry[1], request_id=str(index))
+            pending.clear()
+            try:
+                limiter.call(batch.execute, cost=len(entries))
+            except Exception as e:
+                # The batch as a whole failed, so report every request that got no callback
+                for key, _, _ in list(entries.values()):
+                    on_result(key, None, e)
+
+            if quota_errors:
+                limiter.on_quota_error()
+            if retries:
+                time.sleep(get_backoff_seconds(max(attempt for _, _, attempt in retries) - 1))
+                pending.extend(retries)
+
+    for key, request in requests:
+        pending.append((key, request, 0))
+        limit = batch_size or get_rate_limiter(get_family(request)).batch_size
+        if len(pending) >= limit:
+            flush()
+    if pending:
+        flush()
+
+def execute_in_concurrent_batches(scopes, items, build_request, on_result, batch_size=None, max_workers=4):
+    """
+    Like execute_in_batches, but sends up to max_workers batches at the same time.
+    Every worker thread uses its own service, since a service's connection is not thread-safe.
+    :param scopes: Scopes to build the services with.
+    :param items: List of keys, one request each.
+    :param build_request: Called as build_request(service, key); returns the HttpRequest for that key.
+    :param on_result: Called as on_result(key, response, exception) once per request, one call at a time.
+    :param batch_size: Number of requests handed to a worker at a time; if None, the adaptive batch size of the
+                       requests' API family at the moment the worker takes them, so chunks grow and shrink with it.
+    """
+    if not items:
+        return
+
+    # Building a request sends nothing; it only tells which API family, and so which rate limiter, is used
+    limiter = get_rate_limiter(get_family(build_request(get_service(scopes), items[0])))
+    chunk_lock = threading.Lock()
+    result_lock = threading.Lock()
+    position = 0
+
+    def take_chunk():
+        nonlocal position
+        with chunk_lock:
+            chunk = items[position:position + (batch_size or limiter.batch_size)]
+            position += len(chunk)
+            return chunk
+
+    def on_result_locked(key, response, exception):
+        with result_lock:
+            on_result(key, response, exception)
+
+    def send_chunks():
+        service = get_service(scopes)
+        chunk = take_chunk()
+        while chunk:
+            requests = ((key, build_request(service, key)) for key in chunk)
+            execute_in_batches(service, requests, on_result_locked, batch_size=batch_size)
+            chunk = take_chunk()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(send_chunks) for _ in range(max_workers)]:
+            future.result()
+
+def list_members_in_batches(scopes, group_emails, fields, roles=None, max_workers=4):
+    """
+    Lists the members of many groups with batched members().list calls, sending up to max_workers batches at a time.
+    The first page of every group goes out in the first round of batches; the groups with more pages
+    get their next page in the following round, until every group is complete.
+    :param scopes: Scopes to build the services with.
+    :param group_emails: List of group emails.
+    :param fields: Partial-response fields= mask for the list call, see build_fields_mask().
+    :param roles: Only list the members with these roles (e.g. 'OWNER'); all members if None.
+    :return: Tuple (members_per_group, failed): {group email: [members]} and {group email: exception}.
+    """
+    members_per_group = {group_email: [] for group_email in group_emails}
+    failed = {}
+    page_tokens = dict.fromkeys(group_emails)
+    next_page_tokens = {}
+
+    def build_request(service, group_email):
+        return service.members().list(groupKey=group_email, roles=roles, maxResults=200,
+                                      pageToken=page_tokens[group_email], fields=fields)
+
+    def on_result(group_email, response, exception):
+        if exception is not None:
+            failed[group_email] = exception
+            return
+        members_per_group[group_email].extend(response.get('members', []))
+        if response.get('nextPageToken'):
+            next_page_tokens[group_email] = response['nextPageToken']
+
+    while page_tokens:
+        execute_in_concurrent_batches(scopes, list(page_tokens), build_request, on_result, max_workers=max_workers)
+        page_tokens = dict(next_page_tokens)
+        next_page_tokens.clear()
+
+    return members_per_group, failed
+
+def move_users_in_batches(service, moves, batch_size=None):
+    """
+    Moves users to their target OU using batched users().update calls.
+    Only the orgUnitPath field is sent, and only the fields needed for reporting are returned.
+    :param service: The Admin SDK Directory service.
+    :param moves: Iterable of (email, domain, target_ou) tuples.
+    :param batch_size: Maximum number of updates per batch; the rate limiter's adaptive batch size if None.
+    :return: Tuple (moved_count_per_domain, failed_per_domain).
+    """
+    moved_count_per_domain = defaultdict(int)
+    failed_per_domain = defaultdict(list)
+
+    def on_result(move, response, exception):
+        email, domain, target_ou = move
+        if exception is not None:
+            print(f'Failed to move {email} to {target_ou}: {exception}')
+            failed_per_domain[domain].append(email)
+        else:
+            print(f'Successfully moved {email} to {target_ou}')
+            moved_count_per_domain[domain] += 1
+
+    requests = (
+        ((email, domain, target_ou),
+         service.users().update(userKey=email, body={"orgUnitPath": target_ou}, fields='primaryEmail,orgUnitPath'))
+        for email, domain, target_ou in moves
+    )
+    execute_in_batches(service, requests, on_result, batch_size=batch_size)
+
+    return moved_count_per_domain, failed_per_domain
@@ -0,0 +1,178 @@
+import os
+import sqlite3
+import sys
+import time
+
+# Local copy of the directory for ad-hoc questions and for stages that select their rows with a query.
+# The pull, merge and export stages load their tables into it; nothing in it comes from the API directly.
+cache_path = os.path.join(os.path.dirname(__file__), '../csv/directory_cache.sqlite')
+
+# Columns per table, all stored as the same strings the CSV files hold.
+# 'domain' is derived from the email column on load, so per-school queries can use an index.
+tables = {
+    'users': ['id', 'primaryEmail', 'firstName', 'lastName', 'orgUnitPath', 'lastLoginTime', 'suspended',
+              'isAdmin', 'updated', 'domain'],
+    'merged_users': ['userPrincipalName', 'jobTitle', 'department', 'companyName', 'suspended', 'orgUnitPath',
+                     'isAdmin', 'domain'],
+    'devices': ['deviceId', 'serialNumber', 'model', 'status', 'lastSync', 'assetId', 'location',
+                'lastKnownUserEmail', 'orgUnitPath'],
+    'groups': ['email', 'name', 'description', 'directMembersCount', 'adminCreated', 'aliases', 'owners', 'domain'],
+    'memberships': ['groupEmail', 'memberEmail', 'role', 'type', 'status'],
+    'roles': ['roleName', 'userPrincipalName', 'suspended', 'userOrgUnitPath', 'roleScopeType']
+}
+
+# Column the domain is derived from, for the tables that have one
+domain_columns = {'users': 'primaryEmail', 'merged_users': 'userPrincipalName', 'groups': 'email'}
+
+# Indexes for the lookups and selections the stages and reports make
+indexes = {
+    'users': [['primaryEmail'], ['id'], ['domain', 'orgUnitPath'], ['orgUnitPath'], ['suspended']],
+    'merged_users': [['userPrincipalName'], ['domain', 'jobTitle'], ['jobTitle', 'orgUnitPath'],
+                     ['suspended', 'orgUnitPath'], ['isAdmin', 'orgUnitPath']],
+    'devices': [['serialNumber'], ['orgUnitPath'], ['lastKnownUserEmail']],
+    'groups': [['email'], ['domain']],
+    'memberships': [['groupEmail', 'role'], ['memberEmail']],
+    'roles': [['userPrincipalName'], ['roleName']]
+}
+
+# CSV file each table is loaded from; a table older than its CSV is not used, since the CSV has newer data
+csv_dir = os.path.join(os.path.dirname(__file__), '../csv')
+csv_paths = {
+    'users': os.path.join(csv_dir, 'user/core/all_google_user_data.csv'),
+    'merged_users': os.path.join(csv_dir, 'user/merged/merged_user_data.csv'),
+    'devices': os.path.join(csv_dir, 'device/core/all_google_device_data_all.csv'),
+    'groups': os.path.join(csv_dir, 'groups/core/all_google_group_data.csv'),
+    'memberships': os.path.join(csv_dir, 'groups/core/all_google_group_memberships.csv'),
+    'roles': os.path.join(csv_dir, 'user/core/admin_google_user_data.csv')
+}
+
+# Boolean columns, stored as 'True' or 'False' however the source wrote them
+boolean_columns = {'suspended', 'isAdmin'}
+
+# How 'true' is stored in the boolean columns; compared with IN so the queries read like the CSV checks
+true_values = ('True',)
+
+def is_enabled():
+    """Returns True unless DIRECTORY_CACHE is set to false in config.json."""
+    # Imported here, so queries against the cache do not need config.json
+    from admin_client import load_config
+
+    return load_config().get('DIRECTORY_CACHE', True)
+
+def connect():
+    """
+    Opens a connection to the cache, creating the tables and indexes if needed.
+    Every stage opens its own connection, since stages run on different threads.
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    # Readers can query while a pull stage loads a table
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    with connection:
+        for table, columns in tables.items():
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(f"{column} TEXT" for column in columns)})')
+            for index_columns in indexes.get(table, []):
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_{"_".join(index_columns)} '
+                                   f'ON {table} ({", ".join(index_columns)})')
+        connection.execute('CREATE TABLE IF NOT EXISTS loaded_tables '
+                           '(name TEXT PRIMARY KEY, row_count INTEGER, loaded_at REAL)')
+    return connection
+
+def to_value(value, column=None):
+    """
+    Stores a value as the string a CSV would hold, without surrounding spaces.
+    Boolean columns are stored as 'True' or 'False', so ' true' selects the same users as the CSV checks do.
+    """
+    value = '' if value is None else str(value).strip()
+    if column in boolean_columns and value.lower() in ('true', 'false'):
+        return value.capitalize()
+    return value
+
+def load_table(table, rows):
+    """
+    Replaces a table of the cache with the given rows, in one transaction with a bulk insert.
+    Does nothing if the cache is disabled.
+    :param rows: List of dictionaries with (at least) the columns of the table; missing columns are stored empty.
+    """
+    if not is_enabled():
+        return
+
+    start_time = time.time()
+    columns = tables[table]
+    domain_column = domain_columns.get(table)
+
+    def to_record(row):
+        record = [to_value(row.get(column), column) for column in columns if column != 'domain']
+        if domain_column:
+            email = to_value(row.get(domain_column))
+            record.append(email.rsplit('@', 1)[1].lower() if '@' in email else '')
+        return record
+
+    connection = connect()
+    try:
+        with connection:
+            connection.execute(f'DELETE FROM {table}')
+            connection.executemany(
+                f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+                (to_record(row) for row in rows)
+            )
+            connection.execute('INSERT OR REPLACE INTO loaded_tables VALUES (?, ?, ?)', (table, len(rows), time.time()))
+    finally:
+        connection.close()
+    print(f"Loaded {len(rows)} rows into the {table} table of the directory cache in {time.time() - start_time:.2f} seconds")
+
+def has_table(table):
+    """
+    Returns True if the cache is enabled and a stage has loaded the table since its CSV file was last written.
+    A CSV written without loading the cache (e.g. by a run with the cache disabled) makes the table stale.
+    """
+    if not is_enabled() or not os.path.exists(cache_path):
+        return False
+    connection = connect()
+    try:
+        loaded = connection.execute('SELECT loaded_at FROM loaded_tables WHERE name = ?', (table,)).fetchone()
+    finally:
+        connection.close()
+    if loaded is None:
+        return False
+    csv_path = csv_paths.get(table)
+    return csv_path is None or not os.path.exists(csv_path) or loaded['loaded_at'] >= os.path.getmtime(csv_path)
+
+def query(sql, parameters=()):
+    """
+    Runs a query against the cache.
+    :return: List of dictionaries {column: value}.
+    """
+    connection = connect()
+    try:
+        return [dict(row) for row in connection.execute(sql, parameters)]
+    finally:
+        connection.close()
+
+def get_columns(table):
+    """Returns the columns of a table as the CSV has them, without the derived domain."""
+    return [column for column in tables[table] if column != 'domain']
+
+def select_rows(table, where='1', parameters=()):
+    """
+    Selects the rows of a table that match a WHERE clause, in the order they were loaded,
+    with the columns of the CSV (without the derived domain).
+    """
+    return query(f'SELECT {", ".join(get_columns(table))} FROM {table} WHERE {where} ORDER BY rowid', parameters)
+
+if __name__ == '__main__':
+    # Ad-hoc report, e.g. the Leerling users of a school outside their class OU:
+    # python directory_cache.py "SELECT userPrincipalName, department, orgUnitPath FROM merged_users
+    #     WHERE domain = 'school.be' AND jobTitle = 'Leerling'
+    #     AND orgUnitPath != '/@' || domain || '/1.Users/1.4Leerling/' || department"
+    if len(sys.argv) < 2:
+        print('Usage: python directory_cache.py "<SQL query>"')
+        sys.exit(1)
+
+    start_time = time.time()
+    rows = query(sys.argv[1])
+    for row in rows:
+        print(', '.join(f"{column}={value}" for column, value in row.items()))
+    print(f"{len(rows)} rows in {(time.time() - start_time) * 1000:.1f} ms")
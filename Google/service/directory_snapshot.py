@@ -0,0 +1,84 @@
+import os
+import threading
+from collections import defaultdict
+from snapshot_store import has_snapshot, read_rows
+
+# Tables written by the pull stages, loaded from their snapshot (or CSV) when no stage registered them in this process
+csv_dir = os.path.join(os.path.dirname(__file__), '../csv')
+table_paths = {
+    'users': os.path.join(csv_dir, 'user/core/all_google_user_data.csv'),
+    'groups': os.path.join(csv_dir, 'groups/core/all_google_group_data.csv')
+}
+
+def get_domain(email):
+    """Returns the lowercased domain of an email address, without '@'; '' if it has none."""
+    return email.rsplit('@', 1)[1].lower() if email and '@' in email else ''
+
+class DirectorySnapshot:
+    """
+    The users and groups of one pull, with the indexes the stages look them up by built once and shared:
+    users by id and groups by domain.
+    Indexes are built on first use and rebuilt when a table is replaced.
+    """
+
+    def __init__(self, users=None, groups=None):
+        self._tables = {}
+        self._indexes = {}
+        self._lock = threading.RLock()
+        for name, rows in (('users', users), ('groups', groups)):
+            if rows is not None:
+                self._tables[name] = list(rows)
+
+    def set_table(self, name, rows):
+        """Replaces a table with fresh rows, e.g. from a pull stage, and drops its indexes."""
+        with self._lock:
+            self._tables[name] = list(rows)
+            self._indexes = {key: index for key, index in self._indexes.items() if key[0] != name}
+
+    def get_table(self, name):
+        """Returns the rows of a table, loading it from its snapshot or CSV file the first time; [] if there is none."""
+        with self._lock:
+            if name not in self._tables:
+                path = table_paths[name]
+                self._tables[name] = read_rows(path) if has_snapshot(path) or os.path.exists(path) else []
+            return self._tables[name]
+
+    def _get_index(self, table, name, key, unique=False):
+        """
+        Returns the index `name` of a table, building it on first use.
+        :param key: Function returning the index key of a row; rows with an empty key are left out of unique indexes.
+        :param unique: Map every key to one row instead of to a list of rows.
+        """
+        with self._lock:
+            if (table, name) not in self._indexes:
+                rows = self.get_table(table)
+                if unique:
+                    index = {key(row): row for row in rows if key(row)}
+                else:
+                    index = defaultdict(list)
+                    for row in rows:
+                        index[key(row)].append(row)
+                self._indexes[(table, name)] = index
+            return self._indexes[(table, name)]
+
+    @property
+    def users_by_id(self):
+        return self._get_index('users', 'id', lambda row: row.get('id'), unique=True)
+
+    @property
+    def groups_by_domain(self):
+        return self._get_index('groups', 'domain', lambda row: get_domain(row.get('email')))
+
+_snapshot = None
+_lock = threading.Lock()
+
+def get_directory_snapshot():
+    """
+    Returns the directory snapshot shared by every stage in this process.
+    Pull stages register their rows with set_table(); tables no stage registered are loaded from their files.
+    """
+    global _snapshot
+    with _lock:
+        if _snapshot is None:
+            _snapshot = DirectorySnapshot()
+        return _snapshot
@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import hashlib
+
+class FingerprintStore:
+    """
+    Persisted record of the rows seen on the previous sync, keyed by a stable id (user id, serial number, ...).
+    Every entry keeps the row, its fingerprint over the columns that matter downstream and, when the API
+    provides one, the etag. diff() compares a fresh pull against it to find new, changed and deleted rows.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_full_refresh = None
+        self.entries = {}  # {key: {'fingerprint': str, 'etag': str or None, 'row': dict}}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as store_file:
+                state = json.load(store_file)
+            self.last_full_refresh = state.get('last_full_refresh')
+            self.entries = state.get('entries', {})
+
+    @staticmethod
+    def fingerprint(row, columns):
+        """Returns a hash of the given columns of the row, compared as the strings a CSV would hold."""
+        values = [str(row.get(column, '')) for column in columns]
+        return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+    def needs_full_refresh(self, max_age_days):
+        """Returns True if the store is empty or its last full refresh is older than max_age_days."""
+        if not self.entries or self.last_full_refresh is None:
+            return True
+        return time.time() - self.last_full_refresh > max_age_days * 86400
+
+    def diff(self, rows_by_key, columns, etags=None):
+        """
+        Compares a fresh pull against the store.
+        :param rows_by_key: Dictionary {key: row} of every row currently in the source.
+        :param columns: Columns whose changes matter downstream.
+        :param etags: Optional dictionary {key: etag}; an unchanged etag skips the fingerprint comparison.
+        :return: Tuple (new, changed, deleted) of row lists; deleted holds the rows as last stored.
+        """
+        etags = etags or {}
+        new, changed = [], []
+        for key, row in rows_by_key.items():
+            entry = self.entries.get(key)
+            if entry is None:
+                new.append(row)
+            elif etags.get(key) is not None and etags.get(key) == entry.get('etag'):
+                continue
+            elif self.fingerprint(row, columns) != entry['fingerprint']:
+                changed.append(row)
+        deleted = [entry['row'] for key, entry in self.entries.items() if key not in rows_by_key]
+        return new, changed, deleted
+
+    def replace(self, rows_by_key, columns, etags=None, full_refresh=False):
+        """Replaces the stored entries with the fresh pull, marking it as a full refresh if requested."""
+        etags = etags or {}
+        self.entries = {
+            key: {'fingerprint': self.fingerprint(row, columns), 'etag': etags.get(key), 'row': row}
+            for key, row in rows_by_key.items()
+        }
+        if full_refresh:
+            self.last_full_refresh = time.time()
+
+    def save(self):
+        """Writes the store to disk, replacing the previous file only once it is complete."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as store_file:
+            json.dump({'last_full_refresh': self.last_full_refresh, 'entries': self.entries}, store_file)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,62 @@
+import threading
+from collections import defaultdict
+
+class OrgUnitIndex:
+    """
+    In-memory index of the organizational unit tree, loaded with one orgunits().list(type='all') call.
+    Answers exists/children/path lookups without further API calls. OUs created during a run
+    should be added with add() so the index stays in sync.
+    """
+
+    def __init__(self, org_units=()):
+        self._by_path = {'/': {'name': '', 'orgUnitPath': '/', 'parentOrgUnitPath': None}}
+        self._children = defaultdict(dict)  # {parent_path: {name: path}}
+        for org_unit in org_units:
+            self.add(org_unit)
+
+    @classmethod
+    def load(cls, service):
+        """Builds the index from a single orgunits().list(type='all') call."""
+        response = service.orgunits().list(
+            customerId='my_customer',
+            type='all',
+            fields='organizationUnits(name,orgUnitPath,parentOrgUnitPath,orgUnitId,parentOrgUnitId)'
+        ).execute()
+        return cls(response.get('organizationUnits', []))
+
+    def add(self, org_unit):
+        """Adds an OU (as returned by orgunits().list/insert) to the index."""
+        path = org_unit['orgUnitPath']
+        parent_path = org_unit.get('parentOrgUnitPath') or path.rsplit('/', 1)[0] or '/'
+        self._by_path[path] = org_unit
+        self._children[parent_path][org_unit['name']] = path
+
+    def exists(self, path):
+        """Returns True if the OU path exists."""
+        return path in self._by_path
+
+    def get(self, path):
+        """Returns the OU for the given path, or None if it doesn't exist."""
+        return self._by_path.get(path)
+
+    def has_child(self, parent_path, name):
+        """Returns True if an OU with the given name exists directly under parent_path."""
+        return name in self._children.get(parent_path, {})
+
+    def children(self, parent_path):
+        """Returns the paths of the OUs directly under parent_path."""
+        return list(self._children.get(parent_path, {}).values())
+
+_shared_index = None
+_lock = threading.Lock()
+
+def get_ou_index(service):
+    """
+    Returns the OU index shared by every script running in this process, loading it on first use.
+    Stages running on other threads wait for the first load instead of listing the OUs again.
+    """
+    global _shared_index
+    with _lock:
+        if _shared_index is None:
+            _shared_index = OrgUnitIndex.load(service)
+        return _shared_index
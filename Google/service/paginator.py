@@ -0,0 +1,105 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from admin_client import new_http
+
+# Pages fetched ahead of the page being processed
+PREFETCH_PAGES = 2
+
+_end_of_pages = object()
+
+def _put_until_stopped(queue, item, stop):
+    """Waits for room in the queue, but gives up once the reader has stopped."""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.5)
+            return
+        except Full:
+            continue
+
+def _drain(queue):
+    try:
+        while True:
+            queue.get_nowait()
+    except Empty:
+        pass
+
+def iter_pages(collection, request, items_key, scopes, prefetch=PREFETCH_PAGES):
+    """
+    Yields the items of every page of a list request, fetching the next pages on a background thread
+    while the caller processes the current one. At most `prefetch` pages wait in the queue.
+    The background thread uses its own HTTP connection, since httplib2 connections are not thread-safe.
+    :param collection: The collection the request was made on, e.g. service.users(); used for list_next.
+    :param request: The first list request.
+    :param items_key: Name of the list in the response, such as 'users' or 'members'.
+    :param scopes: Scopes of the service, to authorize the background connection.
+    """
+    pages = Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def fetch_pages():
+        try:
+            http = new_http(scopes)
+            next_request = request
+            while next_request is not None and not stop.is_set():
+                response = next_request.execute(http=http)
+                _put_until_stopped(pages, response, stop)
+                next_request = collection.list_next(previous_request=next_request, previous_response=response)
+            _put_until_stopped(pages, _end_of_pages, stop)
+        except Exception as e:
+            _put_until_stopped(pages, e, stop)
+
+    fetcher = threading.Thread(target=fetch_pages, daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _end_of_pages:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page.get(items_key, [])
+    finally:
+        # Let the fetcher finish if the caller stops early
+        stop.set()
+        _drain(pages)
+
+def merge_page_streams(streams, max_workers, prefetch=PREFETCH_PAGES):
+    """
+    Reads several page streams (shards) on a pool of workers and yields their pages as they arrive.
+    :param streams: Dictionary {shard key: function returning an iterable of pages}; each function runs on a
+                    worker thread, so it should get its service there with get_service().
+    :param max_workers: Number of shards read at the same time.
+    :return: Generator of (shard key, page) tuples. The first error of a shard is re-raised.
+    """
+    pages = Queue(maxsize=prefetch * max_workers)
+    stop = threading.Event()
+
+    def read_stream(key, stream):
+        try:
+            for page in stream():
+                if stop.is_set():
+                    return
+                _put_until_stopped(pages, (key, page), stop)
+            _put_until_stopped(pages, (key, _end_of_pages), stop)
+        except Exception as e:
+            _put_until_stopped(pages, (key, e), stop)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for key, stream in streams.items():
+            executor.submit(read_stream, key, stream)
+
+        remaining = len(streams)
+        while remaining:
+            key, page = pages.get()
+            if page is _end_of_pages:
+                remaining -= 1
+                continue
+            if isinstance(page, Exception):
+                raise page
+            yield key, page
+    finally:
+        stop.set()
+        _drain(pages)
+        executor.shutdown(wait=False, cancel_futures=True)
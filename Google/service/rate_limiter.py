@@ -0,0 +1,172 @@
+import json
+import random
+import threading
+import time
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+# Requests per second per API family unless RATE_LIMITS in config.json says otherwise.
+# All families share the per-user Directory API quota of the delegated admin, so the defaults stay well below it.
+DEFAULT_RATE = 10
+
+# Concurrency and batch size start here and move between 1 and the maximum (AIMD)
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+INITIAL_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
+
+# Consecutive successes before concurrency and batch size grow by one step
+SUCCESSES_PER_STEP = 20
+BATCH_SIZE_STEP = 5
+
+# Retries with exponential backoff and jitter
+MAX_RETRIES = 6
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 64
+
+QUOTA_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'}
+
+def get_error_reason(error):
+    """Returns the reason of an HttpError, such as 'rateLimitExceeded', or None."""
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def is_quota_error(error):
+    """Returns True for 429 responses and 403 responses caused by the rate limit or quota."""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and get_error_reason(error) in QUOTA_REASONS)
+
+def is_transient_error(error):
+    """Returns True for server errors that are worth retrying as they are."""
+    return isinstance(error, HttpError) and error.resp.status in (500, 502, 503, 504)
+
+def get_backoff_seconds(attempt):
+    """Exponential backoff with full jitter for the given retry attempt (0 for the first retry)."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, with bursts of up to `capacity` calls.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until the tokens are available and takes them.
+        A cost larger than the bucket (a big batch) waits for a full bucket and then takes its full cost,
+        leaving the bucket in debt, so the calls after it wait until the whole batch has been paid for.
+        """
+        needed = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                wait = (needed - self._tokens) / self.rate
+            time.sleep(wait)
+
+class RateLimiter:
+    """
+    Call executor for one API family (users, orgunits, groups, members, chromeosdevices, ...).
+    Calls take a token from the family's bucket and one of its concurrency slots, and are retried with
+    exponential backoff and jitter on quota and server errors. Concurrency and batch size grow by one step
+    after a run of successes and are halved on every quota error (AIMD).
+    """
+
+    def __init__(self, family, rate):
+        self.family = family
+        self.bucket = TokenBucket(rate)
+        self.concurrency = INITIAL_CONCURRENCY
+        self.batch_size = INITIAL_BATCH_SIZE
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= SUCCESSES_PER_STEP:
+                self._successes = 0
+                self.concurrency = min(MAX_CONCURRENCY, self.concurrency + 1)
+                self.batch_size = min(MAX_BATCH_SIZE, self.batch_size + BATCH_SIZE_STEP)
+                self._condition.notify_all()
+
+    def on_quota_error(self):
+        with self._condition:
+            self._successes = 0
+            self.concurrency = max(1, self.concurrency // 2)
+            self.batch_size = max(1, self.batch_size // 2)
+            print(f"Quota reached for {self.family}: concurrency {self.concurrency}, batch size {self.batch_size}")
+
+    def _enter(self):
+        with self._condition:
+            while self._active >= self.concurrency:
+                self._condition.wait()
+            self._active += 1
+
+    def _leave(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def call(self, function, cost=1):
+        """
+        Runs function() within the family's rate and concurrency limits, retrying quota and server errors.
+        :param cost: Number of API calls the function makes, e.g. the size of a batch.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            self._enter()
+            try:
+                self.bucket.acquire(cost)
+                result = function()
+                self.on_success()
+                return result
+            except HttpError as e:
+                if attempt == MAX_RETRIES or not (is_quota_error(e) or is_transient_error(e)):
+                    raise
+                if is_quota_error(e):
+                    self.on_quota_error()
+            finally:
+                self._leave()
+            time.sleep(get_backoff_seconds(attempt))
+
+_limiters = {}
+_lock = threading.Lock()
+
+def get_rate_limiter(family):
+    """Returns the rate limiter shared by every call of the given API family in this process."""
+    # Imported here, since admin_client builds its services with RateLimitedHttpRequest from this module
+    from admin_client import load_config
+
+    with _lock:
+        if family not in _limiters:
+            rate = load_config().get('RATE_LIMITS', {}).get(family, DEFAULT_RATE)
+            _limiters[family] = RateLimiter(family, rate)
+        return _limiters[family]
+
+def get_family(request):
+    """Returns the API family of a request, e.g. 'users' for directory.users.list."""
+    method_parts = (request.methodId or '').split('.')
+    return method_parts[1] if len(method_parts) > 2 else 'other'
+
+class RateLimitedHttpRequest(HttpRequest):
+    """
+    HttpRequest whose execute() goes through the rate limiter of its API family.
+    Services built by admin_client.get_service use it for every request.
+    """
+
+    def execute(self, http=None, num_retries=0):
+        return get_rate_limiter(get_family(self)).call(lambda: super(RateLimitedHttpRequest, self).execute(http=http))
@@ -0,0 +1,139 @@
+import csv
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional; without it only the CSV files are written and read
+    pa = None
+    pq = None
+
+# Every CSV the pipeline writes gets a Parquet snapshot next to it, e.g. merged_user_data.parquet.
+# The CSV stays for opening in Excel; the stages read the snapshot, which keeps a schema, compresses
+# repeated values with dictionary encoding and can be read column by column from a memory map.
+COMPRESSION = 'zstd'
+
+def is_available():
+    """Returns True if pyarrow is installed and snapshots are enabled (WRITE_SNAPSHOTS in config.json, default true)."""
+    # Imported here, so reading a snapshot does not need config.json
+    from admin_client import load_config
+
+    return pq is not None and load_config().get('WRITE_SNAPSHOTS', True)
+
+def get_snapshot_path(csv_path):
+    """Returns the path of the snapshot belonging to a CSV file."""
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+def get_schema(columns):
+    """
+    Returns the schema of a snapshot: every column is a string, holding the same value as the CSV,
+    so readers of the snapshot and of the CSV see the same rows.
+    """
+    return pa.schema([(column, pa.string()) for column in columns])
+
+def to_table(rows, columns):
+    """
+    Converts rows (a list of dictionaries or a DataFrame) to an Arrow table with the values as the strings
+    a CSV would hold.
+    """
+    if isinstance(rows, pd.DataFrame):
+        frame = rows[columns].astype(object)
+        frame = frame.where(frame.notna(), '').astype(str)
+        return pa.Table.from_pandas(frame, schema=get_schema(columns), preserve_index=False)
+    return pa.Table.from_pydict(
+        {column: ['' if row.get(column) is None else str(row.get(column)) for row in rows] for column in columns},
+        schema=get_schema(columns)
+    )
+
+class SnapshotWriter:
+    """
+    Writes a snapshot in row groups, for stages that produce their rows page by page.
+    Does nothing if snapshots are not available, so callers need no checks of their own.
+    The file is written under a temporary name and only replaces the previous snapshot when closed.
+    """
+
+    def __init__(self, csv_path, columns):
+        self.path = get_snapshot_path(csv_path)
+        self.columns = columns
+        self._writer = None
+        if is_available():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._writer = pq.ParquetWriter(self.path + '.tmp', get_schema(columns), compression=COMPRESSION)
+
+    def write_rows(self, rows):
+        if self._writer is not None and len(rows):
+            self._writer.write_table(to_table(rows, self.columns))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_snapshot(csv_path, rows, columns):
+    """
+    Writes the snapshot of a CSV file in one go.
+    :param rows: List of dictionaries, or a DataFrame.
+    :param columns: Columns of the snapshot, in the order of the CSV.
+    """
+    with SnapshotWriter(csv_path, columns) as writer:
+        writer.write_rows(rows)
+
+def has_snapshot(csv_path):
+    """Returns True if the CSV file has a snapshot that pyarrow can read and that is not older than the CSV."""
+    snapshot_path = get_snapshot_path(csv_path)
+    if pq is None or not os.path.exists(snapshot_path):
+        return False
+    return not os.path.exists(csv_path) or os.path.getmtime(snapshot_path) >= os.path.getmtime(csv_path)
+
+def read_table(csv_path, columns=None):
+    """
+    Reads the snapshot of a CSV file as an Arrow table, memory-mapped and only the given columns.
+    Columns missing from the snapshot are left out.
+    """
+    snapshot_path = get_snapshot_path(csv_path)
+    if columns is not None:
+        available = set(pq.read_schema(snapshot_path).names)
+        columns = [column for column in columns if column in available]
+    return pq.read_table(snapshot_path, columns=columns, memory_map=True)
+
+def read_frame(csv_path, columns=None, dtype=None, **csv_options):
+    """
+    Reads a table as a DataFrame: from its snapshot when there is one, otherwise from the CSV file.
+    :param columns: Only read these columns.
+    :param dtype: Dictionary {column: dtype} to convert the columns to, e.g. 'category'.
+    :param csv_options: Extra pandas.read_csv arguments, used when the CSV file is read.
+    """
+    if has_snapshot(csv_path):
+        frame = read_table(csv_path, columns).to_pandas()
+        # Empty strings are how the snapshot stores what the CSV leaves empty
+        frame = frame.replace('', None)
+        if dtype:
+            frame = frame.astype({column: kind for column, kind in dtype.items() if column in frame.columns})
+        return frame
+
+    if columns is not None:
+        wanted = set(columns)
+        csv_options['usecols'] = lambda column: column in wanted
+    return pd.read_csv(csv_path, dtype=dtype, **csv_options)
+
+def read_rows(csv_path, columns=None):
+    """
+    Reads a table as a list of dictionaries of strings, like csv.DictReader: from its snapshot when there
+    is one, otherwise from the CSV file.
+    """
+    if has_snapshot(csv_path):
+        return read_table(csv_path, columns).to_pylist()
+
+    with open(csv_path, mode='r', encoding='utf-8') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    if columns is not None:
+        rows = [{column: row[column] for column in columns if column in row} for row in rows]
+    return rows
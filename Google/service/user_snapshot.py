@@ -0,0 +1,39 @@
+def fetch_live_user_state(service):
+    """
+    Fetches suspended/orgUnitPath for every user with one paginated users().list call.
+    Used as an optional freshness check instead of a users().get per user.
+    :param service: The Admin SDK Directory service.
+    :return: Dictionary {email: {'suspended': bool, 'orgUnitPath': str}}.
+    """
+    user_state = {}
+    request = service.users().list(
+        customer='my_customer',
+        maxResults=500,
+        fields='nextPageToken,users(primaryEmail,suspended,orgUnitPath)'
+    )
+
+    while request is not None:
+        response = request.execute()
+        for user in response.get('users', []):
+            user_state[user['primaryEmail'].lower()] = {
+                'suspended': user.get('suspended', False),
+                'orgUnitPath': user.get('orgUnitPath', '')
+            }
+        request = service.users().list_next(previous_request=request, previous_response=response)
+
+    return user_state
+
+def get_user_state(row, live_user_state=None):
+    """
+    Returns the suspended/orgUnitPath state for a row of merged_user_data.csv.
+    The row itself comes from the google_user_data_pull.py snapshot; when live_user_state
+    is given (see fetch_live_user_state) it takes precedence.
+    :return: Dictionary {'suspended': bool, 'orgUnitPath': str}, or None if the user no longer exists.
+    """
+    if live_user_state is not None:
+        return live_user_state.get(row['userPrincipalName'].lower())
+
+    return {
+        'suspended': str(row.get('suspended', '')).strip().lower() == 'true',
+        'orgUnitPath': row.get('orgUnitPath', '')
+    }
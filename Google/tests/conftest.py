@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The shared helpers are imported by module name, as the scripts do after adding Google/service to sys.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '../service'))
@@ -0,0 +1,135 @@
+import pytest
+
+import directory_batch
+from directory_batch import execute_in_batches, execute_in_concurrent_batches, list_members_in_batches
+from rate_limiter import RateLimiter
+from test_rate_limiter import http_error
+
+
+class FakeRequest:
+    methodId = 'directory.members.insert'
+
+    def __init__(self, key, failures=()):
+        self.key = key
+        self.failures = list(failures)
+
+    def respond(self):
+        return {'key': self.key}
+
+
+class FakeMembersRequest(FakeRequest):
+    methodId = 'directory.members.list'
+
+    # Two pages of members per group
+    pages = {None: ('1', ['owner']), '1': (None, ['member'])}
+
+    def __init__(self, groupKey, roles, maxResults, pageToken, fields):
+        super().__init__((groupKey, pageToken))
+        self.group_key = groupKey
+        self.page_token = pageToken
+
+    def respond(self):
+        next_page_token, members = self.pages[self.page_token]
+        response = {'members': [f"{member}@{self.group_key}" for member in members]}
+        if next_page_token:
+            response['nextPageToken'] = next_page_token
+        return response
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.batch_sizes.append(len(self.requests))
+        for request_id, request in self.requests:
+            if request.failures:
+                self.callback(request_id, None, request.failures.pop(0))
+            else:
+                self.callback(request_id, request.respond(), None)
+
+
+class FakeService:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def members(self):
+        return self
+
+    def list(self, **arguments):
+        if arguments['groupKey'] == 'missing':
+            return FakeRequest('missing', [http_error(404)])
+        return FakeMembersRequest(**arguments)
+
+
+@pytest.fixture(autouse=True)
+def limiter(monkeypatch):
+    limiter = RateLimiter('members', rate=1000)
+    monkeypatch.setattr(directory_batch, 'get_rate_limiter', lambda family: limiter)
+    monkeypatch.setattr(directory_batch.time, 'sleep', lambda seconds: None)
+    return limiter
+
+
+def test_execute_in_batches_reports_every_request_once():
+    service = FakeService()
+    results = {}
+    requests = [(key, FakeRequest(key)) for key in range(7)]
+
+    execute_in_batches(service, requests, lambda key, response, error: results.setdefault(key, (response, error)),
+                       batch_size=3)
+
+    assert service.batch_sizes == [3, 3, 1]
+    assert results == {key: ({'key': key}, None) for key in range(7)}
+
+
+def test_execute_in_batches_retries_quota_and_server_errors(limiter):
+    service = FakeService()
+    results = {}
+    requests = [
+        ('quota', FakeRequest('quota', [http_error(429)])),
+        ('server', FakeRequest('server', [http_error(503)])),
+        ('conflict', FakeRequest('conflict', [http_error(409)]))
+    ]
+
+    execute_in_batches(service, requests, lambda key, response, error: results.setdefault(key, (response, error)),
+                       batch_size=10)
+
+    assert results['quota'] == ({'key': 'quota'}, None)
+    assert results['server'] == ({'key': 'server'}, None)
+    assert results['conflict'][1].resp.status == 409
+    # The retried requests went out in a second batch, and the quota error slowed the family down
+    assert service.batch_sizes == [3, 2]
+    assert limiter.concurrency < 4
+
+
+def test_list_members_in_batches_follows_every_page(monkeypatch):
+    service = FakeService()
+    monkeypatch.setattr(directory_batch, 'get_service', lambda scopes: service)
+
+    members_per_group, failed = list_members_in_batches([], ['a', 'b', 'missing'], fields='members(email)')
+
+    assert members_per_group == {'a': ['owner@a', 'member@a'], 'b': ['owner@b', 'member@b'], 'missing': []}
+    assert failed['missing'].resp.status == 404
+    # One round for the first pages and one for the second pages
+    assert service.batch_sizes == [3, 2]
+
+
+def test_concurrent_batches_follow_the_adaptive_batch_size(monkeypatch, limiter):
+    service = FakeService()
+    monkeypatch.setattr(directory_batch, 'get_service', lambda scopes: service)
+    limiter.batch_size = 80
+    results = []
+
+    execute_in_concurrent_batches([], list(range(200)), lambda service, key: FakeRequest(key),
+                                  lambda key, response, error: results.append(key), max_workers=1)
+
+    assert sorted(results) == list(range(200))
+    assert service.batch_sizes == [80, 80, 40]
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import pytest
+
+import directory_cache
+from directory_cache import has_table, load_table, select_rows
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../scripts/user'))
+import csv_user_data_splitting
+
+
+merged_users = [
+    {'userPrincipalName': 'a@school.be', 'jobTitle': ' Leraar ', 'department': '', 'companyName': '',
+     'suspended': 'False', 'orgUnitPath': '/@school.be', 'isAdmin': 'False'},
+    {'userPrincipalName': 'b@school.be', 'jobTitle': 'Leerling', 'department': '', 'companyName': '',
+     'suspended': ' true', 'orgUnitPath': '/@school.be', 'isAdmin': 'TRUE'},
+    {'userPrincipalName': 'c@school.be', 'jobTitle': 'Directeur', 'department': '', 'companyName': '',
+     'suspended': 'false ', 'orgUnitPath': '/@school.be', 'isAdmin': 'False'},
+    {'userPrincipalName': 'd@school.be', 'jobTitle': '', 'department': '', 'companyName': '',
+     'suspended': '', 'orgUnitPath': '/@school.be', 'isAdmin': ''},
+    {'userPrincipalName': 'e@school.be', 'jobTitle': 'Leerling', 'department': '', 'companyName': '',
+     'suspended': 'False', 'orgUnitPath': '/@school.be', 'isAdmin': 'False'}
+]
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(directory_cache, 'cache_path', str(tmp_path / 'directory_cache.sqlite'))
+    monkeypatch.setattr(directory_cache, 'csv_paths', {'merged_users': str(tmp_path / 'merged_user_data.csv')})
+    monkeypatch.setattr(directory_cache, 'is_enabled', lambda: True)
+    return tmp_path
+
+
+def get_emails(split):
+    return {group: [row['userPrincipalName'] for row in rows] for group, rows in split.items()}
+
+
+def test_load_table_trims_values_and_normalizes_booleans():
+    load_table('merged_users', merged_users)
+    rows = select_rows('merged_users', "userPrincipalName = ?", ('b@school.be',))
+    assert rows[0]['suspended'] == 'True'
+    assert rows[0]['isAdmin'] == 'True'
+    assert select_rows('merged_users', "jobTitle = ?", ('Leraar',))[0]['userPrincipalName'] == 'a@school.be'
+
+
+def test_split_from_cache_matches_the_python_split():
+    load_table('merged_users', merged_users)
+    assert get_emails(csv_user_data_splitting.split_users_from_cache()) == \
+        get_emails(csv_user_data_splitting.split_users(merged_users))
+
+
+def test_has_table_ignores_a_table_older_than_its_csv(cache):
+    assert not has_table('merged_users')
+
+    csv_path = cache / 'merged_user_data.csv'
+    csv_path.write_text('userPrincipalName\n')
+    load_table('merged_users', merged_users)
+    assert has_table('merged_users')
+
+    # The CSV was written again without loading the cache, e.g. with the cache disabled
+    loaded_at = directory_cache.query('SELECT loaded_at FROM loaded_tables')[0]['loaded_at']
+    os.utime(csv_path, (loaded_at + 10, loaded_at + 10))
+    assert not has_table('merged_users')
+
+
+@pytest.mark.parametrize('rows', [[], [merged_users[4]]])
+def test_split_csvs_are_the_same_from_the_cache_and_from_rows(monkeypatch, cache, rows):
+    def write_split_csvs(directory, merged_rows):
+        monkeypatch.setattr(csv_user_data_splitting, 'split_csv_paths', {
+            group: str(directory / f"{group}.csv") for group in csv_user_data_splitting.split_csv_paths
+        })
+        csv_user_data_splitting.main(merged_rows)
+        return {path.name: path.read_text() for path in directory.glob('*.csv')}
+
+    monkeypatch.setattr(csv_user_data_splitting, 'write_snapshot', lambda *args: None)
+    load_table('merged_users', rows)
+    from_cache = write_split_csvs(cache / 'from_cache', None)
+    from_rows = write_split_csvs(cache / 'from_rows', rows)
+
+    assert len(from_cache) == len(csv_user_data_splitting.split_csv_paths)
+    assert from_cache == from_rows
+    assert all(content.startswith('userPrincipalName,jobTitle,') for content in from_cache.values())
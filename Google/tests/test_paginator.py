@@ -0,0 +1,69 @@
+import pytest
+
+import paginator
+from paginator import iter_pages, merge_page_streams
+
+
+class FakeRequest:
+    def __init__(self, page_number, pages):
+        self.page_number = page_number
+        self.pages = pages
+
+    def execute(self, http=None):
+        response = self.pages[self.page_number]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class FakeCollection:
+    def list_next(self, previous_request, previous_response):
+        next_page = previous_request.page_number + 1
+        if next_page >= len(previous_request.pages):
+            return None
+        return FakeRequest(next_page, previous_request.pages)
+
+
+@pytest.fixture(autouse=True)
+def no_http(monkeypatch):
+    monkeypatch.setattr(paginator, 'new_http', lambda scopes: None)
+
+
+def test_iter_pages_yields_every_page_in_order():
+    pages = [{'users': [1, 2]}, {'users': [3]}, {}, {'users': [4]}]
+    assert list(iter_pages(FakeCollection(), FakeRequest(0, pages), 'users', [])) == [[1, 2], [3], [], [4]]
+
+
+def test_iter_pages_reraises_the_error_of_a_page():
+    pages = [{'users': [1]}, ValueError('page failed')]
+    stream = iter_pages(FakeCollection(), FakeRequest(0, pages), 'users', [])
+    assert next(stream) == [1]
+    with pytest.raises(ValueError):
+        next(stream)
+
+
+def test_iter_pages_stops_when_the_caller_stops_early():
+    pages = [{'users': [page]} for page in range(100)]
+    stream = iter_pages(FakeCollection(), FakeRequest(0, pages), 'users', [], prefetch=1)
+    assert next(stream) == [0]
+    stream.close()
+
+
+def test_merge_page_streams_yields_the_pages_of_every_stream():
+    streams = {
+        'a': lambda: iter([[1], [2]]),
+        'b': lambda: iter([[3]]),
+        'c': lambda: iter([])
+    }
+    pages = list(merge_page_streams(streams, max_workers=2))
+    assert sorted(pages) == [('a', [1]), ('a', [2]), ('b', [3])]
+    assert [page for key, page in pages if key == 'a'] == [[1], [2]]
+
+
+def test_merge_page_streams_reraises_the_error_of_a_stream():
+    def failing_stream():
+        yield [1]
+        raise ValueError('shard failed')
+
+    with pytest.raises(ValueError):
+        list(merge_page_streams({'a': failing_stream}, max_workers=1))
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+from googleapiclient.errors import HttpError
+
+import rate_limiter
+from rate_limiter import RateLimiter, TokenBucket, is_quota_error
+
+
+class FakeClock:
+    """Stands in for time.monotonic and time.sleep, so waiting only moves the clock forward."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Waits computed from floating point refills can be too small to move a large clock forward
+        self.now += max(seconds, 1e-6)
+
+
+class FakeResponse(dict):
+    def __init__(self, status):
+        super().__init__()
+        self.status = status
+        self.reason = 'error'
+
+
+def http_error(status, reason=None):
+    content = json.dumps({'error': {'errors': [{'reason': reason}]}}).encode('utf-8') if reason else b''
+    return HttpError(FakeResponse(status), content)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(rate_limiter.time, 'sleep', clock.sleep)
+    monkeypatch.setattr(rate_limiter.random, 'uniform', lambda low, high: high)
+    return clock
+
+
+def test_token_bucket_allows_a_burst_of_its_capacity(clock):
+    bucket = TokenBucket(rate=10)
+    for _ in range(10):
+        bucket.acquire()
+    assert clock.now == 0
+
+
+def test_token_bucket_waits_for_single_calls_beyond_the_rate(clock):
+    bucket = TokenBucket(rate=10)
+    for _ in range(30):
+        bucket.acquire()
+    # 10 calls from the full bucket, the other 20 at 10 per second
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_token_bucket_charges_the_full_cost_of_a_batch(clock):
+    bucket = TokenBucket(rate=10)
+    for _ in range(5):
+        bucket.acquire(100)
+    # 500 calls at 10 per second; the first 10 come from the full bucket and the last batch is paid afterwards
+    assert clock.now == pytest.approx(40.0)
+    bucket.acquire()
+    assert clock.now == pytest.approx(49.1)
+
+
+def test_is_quota_error():
+    assert is_quota_error(http_error(429))
+    assert is_quota_error(http_error(403, 'userRateLimitExceeded'))
+    assert not is_quota_error(http_error(403, 'forbidden'))
+    assert not is_quota_error(http_error(404))
+    assert not is_quota_error(ValueError())
+
+
+def test_rate_limiter_retries_quota_errors_and_halves_concurrency(clock):
+    limiter = RateLimiter('users', rate=100)
+    calls = []
+
+    def function():
+        calls.append(clock.now)
+        if len(calls) < 3:
+            raise http_error(429)
+        return 'done'
+
+    assert limiter.call(function) == 'done'
+    assert len(calls) == 3
+    assert limiter.concurrency == rate_limiter.INITIAL_CONCURRENCY // 4
+    assert limiter.batch_size == rate_limiter.INITIAL_BATCH_SIZE // 4
+
+
+def test_rate_limiter_does_not_retry_other_errors(clock):
+    limiter = RateLimiter('users', rate=100)
+    calls = []
+
+    def function():
+        calls.append(1)
+        raise http_error(404)
+
+    with pytest.raises(HttpError):
+        limiter.call(function)
+    assert len(calls) == 1
+
+
+def test_rate_limiter_grows_after_a_run_of_successes(clock):
+    limiter = RateLimiter('users', rate=1000)
+    for _ in range(rate_limiter.SUCCESSES_PER_STEP):
+        limiter.call(lambda: None)
+    assert limiter.concurrency == rate_limiter.INITIAL_CONCURRENCY + 1
+    assert limiter.batch_size == rate_limiter.INITIAL_BATCH_SIZE + rate_limiter.BATCH_SIZE_STEP
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../scripts/user'))
+import csv_user_data_merge
+from csv_user_data_merge import retry_user_rows, save_sync_state, sync_user_delta
+
+
+def merged_user(email, job_title='Leerling', department='1A'):
+    return {'userPrincipalName': email, 'jobTitle': job_title, 'department': department, 'companyName': 'School',
+            'suspended': 'False', 'orgUnitPath': '/@school.be', 'isAdmin': 'False'}
+
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch, tmp_path):
+    monkeypatch.setattr(csv_user_data_merge, 'sync_state_path', str(tmp_path / 'merged_user_sync_state.json'))
+    monkeypatch.setattr(csv_user_data_merge, 'load_config', lambda: {})
+    monkeypatch.setattr(csv_user_data_merge, 'pending_sync_store', None)
+
+
+def sync(merged_users):
+    new, changed, deleted, full_refresh, csv_user_data_merge.pending_sync_store = sync_user_delta(merged_users)
+    return new, changed, deleted, full_refresh
+
+
+def test_an_intune_change_marks_the_user_as_changed():
+    sync([merged_user('a@school.be'), merged_user('b@school.be')])
+    save_sync_state()
+
+    new, changed, deleted, full_refresh = sync([merged_user('a@school.be', department='2B'),
+                                                merged_user('b@school.be')])
+    assert not full_refresh
+    assert (new, deleted) == ([], [])
+    assert [user['userPrincipalName'] for user in changed] == ['a@school.be']
+
+
+def test_the_state_is_only_saved_when_asked():
+    sync([merged_user('a@school.be')])
+    # No save, e.g. because a later stage failed: the next run is a full refresh again
+    assert sync([merged_user('a@school.be')])[3]
+
+
+def test_users_that_failed_to_move_are_passed_on_again():
+    sync([merged_user('a@school.be'), merged_user('b@school.be')])
+    retry_user_rows(['b@school.be'])
+    save_sync_state()
+
+    new, changed, _, _ = sync([merged_user('a@school.be'), merged_user('b@school.be')])
+    assert [user['userPrincipalName'] for user in new] == ['b@school.be']
+    assert changed == []